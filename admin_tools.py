@@ -15,12 +15,12 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 # ======================================================================
 
-import io, logging, time
+import asyncio, io, logging, time
 from .. import loader, utils, security
 from PIL import Image
-from telethon.errors import (ChatAdminRequiredError, UserAdminInvalidError, FloodWaitError, PhotoCropSizeSmallError)
-from telethon.tl.types import (ChatAdminRights, ChatBannedRights)
-from telethon.tl.functions.channels import (EditAdminRequest, EditBannedRequest, EditPhotoRequest)
+from telethon.errors import (ChatAdminRequiredError, UserAdminInvalidError, FloodWaitError, PhotoCropSizeSmallError, RPCError)
+from telethon.tl.types import (Channel, ChatAdminRights, ChatBannedRights)
+from telethon.tl.functions.channels import (DeleteParticipantHistoryRequest, EditAdminRequest, EditBannedRequest, EditPhotoRequest)
 from telethon.tl.functions.messages import EditChatAdminRequest
 logger = logging.getLogger(__name__)
 
@@ -111,6 +111,10 @@ class AdminToolsMod(loader.Module):
                'banned': '<b>{} banned in chat.</b>',
                'banned_for_reason': '<b>{} banned in chat.\nReason: {}</b>', 
                'ban_none': '<b>No one to ban.</b>',
+               'ban_failed': '<b>Can`t ban, see the logs.</b>',
+               'wiping': '\n<b>Deleting messages... {} deleted.</b>',
+               'wiped': '\n<b>{} messages deleted.</b>',
+               'wipe_failed': '\n<b>Stopped deleting messages after {}, see the logs.</b>',
                'unban_none': '<b>No one to unban.</b>',
                'unbanned': '<b>{} unbanned in chat.</b>',
                'mute_none': '<b>No one to mute.</b>',
@@ -315,25 +319,77 @@ class AdminToolsMod(loader.Module):
                 try:
                     await utils.answer(bon, self.strings('banning', bon))
                     await bon.client(EditBannedRequest(bon.chat_id, user.id, ChatBannedRights(until_date=None, view_messages=True)))
-                    async for msgs in bon.client.iter_messages(bon.to_id, from_user=user.id):
-                        await msgs.delete()
                 except ChatAdminRequiredError:
                     return await utils.answer(bon, self.strings('no_rights', bon))
                 except UserAdminInvalidError:
                     return await utils.answer(bon, self.strings('no_rights', bon))
-                except:
-                    pass
+                except RPCError:
+                    logger.exception("Can't ban %s in %s", user.id, bon.chat_id)
+                    return await utils.answer(bon, self.strings('ban_failed', bon))
                 else:
                     if reason:
-                        return await utils.answer(bon, self.strings('banned_for_reason', bon).format(user.first_name, reason))
-                    if reason == False:
-                        return await utils.answer(bon, self.strings('banned', bon).format(user.first_name, reason))
+                        text = self.strings('banned_for_reason', bon).format(user.first_name, reason)
+                    else:
+                        text = self.strings('banned', bon).format(user.first_name, reason)
+                    await utils.answer(bon, text)
+                    # The history wipe can take minutes in busy chats, so it reports progress in the background
+                    asyncio.ensure_future(self.wipe_history(bon, chat, user, text))
             except ValueError:
                 return await utils.answer(bon, self.strings('no_args', bon))
         else:
             return await utils.answer(bon, self.strings('this_isn`t_a_chat', bon))
 
 
+    async def wipe_history(self, bon, chat, user, text):
+        """Deletes everything the user sent in the chat, editing the ban message with the progress."""
+        deleted = 0
+        last_edit = time.monotonic()
+        try:
+            if isinstance(chat, Channel) and (chat.creator or chat.admin_rights.delete_messages):
+                try:
+                    deleted = await self.delete_participant_history(bon.client, chat, user)
+                except ChatAdminRequiredError:
+                    pass
+                else:
+                    return await utils.answer(bon, text + self.strings('wiped', bon).format(deleted))
+            ids = []
+            async for msg in bon.client.iter_messages(chat, from_user=user.id):
+                ids.append(msg.id)
+                if len(ids) >= 100:
+                    deleted += await self.delete_batch(bon.client, chat, ids)
+                    ids = []
+                    if time.monotonic() - last_edit >= 5:
+                        last_edit = time.monotonic()
+                        await utils.answer(bon, text + self.strings('wiping', bon).format(deleted))
+            if ids:
+                deleted += await self.delete_batch(bon.client, chat, ids)
+        except RPCError:
+            logger.exception("History wipe of %s in %s failed", user.id, chat.id)
+            return await utils.answer(bon, text + self.strings('wipe_failed', bon).format(deleted))
+        await utils.answer(bon, text + self.strings('wiped', bon).format(deleted))
+
+    async def delete_participant_history(self, client, chat, user):
+        """Lets the server delete the whole history, one request per chunk it reports."""
+        deleted = 0
+        while True:
+            try:
+                affected = await client(DeleteParticipantHistoryRequest(chat, user))
+            except FloodWaitError as e:
+                await asyncio.sleep(e.seconds)
+                continue
+            deleted += affected.pts_count
+            if not affected.offset:
+                return deleted
+
+    async def delete_batch(self, client, chat, ids):
+        while True:
+            try:
+                await client.delete_messages(chat, ids)
+                return len(ids)
+            except FloodWaitError as e:
+                await asyncio.sleep(e.seconds)
+
+
     async def unbancmd(self, unbon):
         """Command .unban for unban the user.\nUse: .unban <@ or reply>."""
         if unbon.chat:
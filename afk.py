@@ -16,6 +16,8 @@
 
 from .. import loader, utils
 
+import asyncio
+import collections
 import logging
 import datetime
 import time
@@ -32,28 +34,40 @@ class AFKMod(loader.Module):
                "gone": "<b>I'm goin' AFK</b>",
                "back": "<b>I'm no longer AFK</b>",
                "afk": "<b>I'm AFK right now (since {} ago).</b>",
-               "afk_reason": "<b>I'm AFK right now (since {} ago).\nReason:</b> <i>{}</i>"}
+               "afk_reason": "<b>I'm AFK right now (since {} ago).\nReason:</b> <i>{}</i>",
+               "flush_cfg_doc": "Seconds to batch rate limit changes for before they are saved"}
+
+    def __init__(self):
+        self.config = loader.ModuleConfig("FLUSH_INTERVAL", 10, lambda m: self.strings("flush_cfg_doc", m))
+        self._afk = False
+        self._gone = None
+        self._ratelimit = set()
+        self._flush = None
+        self._users = None
 
     async def client_ready(self, client, db):
         self._db = db
+        self._users = UserFlagCache.shared(client)
         self._me = await client.get_me()
+        self._afk = self._db.get(__name__, "afk", False)
+        self._gone = self._db.get(__name__, "gone", None)
+        self._ratelimit = set(self._db.get(__name__, "ratelimit", []))
 
     async def afkcmd(self, message):
         """.afk [message]"""
-        if utils.get_args_raw(message):
-            self._db.set(__name__, "afk", utils.get_args_raw(message))
-        else:
-            self._db.set(__name__, "afk", True)
-        self._db.set(__name__, "gone", time.time())
-        self._db.set(__name__, "ratelimit", [])
+        self._afk = utils.get_args_raw(message) or True
+        self._gone = time.time()
+        self._ratelimit.clear()
+        self.save()
         await self.allmodules.log("afk", data=utils.get_args_raw(message) or None)
         await utils.answer(message, self.strings("gone", message))
 
     async def unafkcmd(self, message):
         """Remove the AFK status"""
-        self._db.set(__name__, "afk", False)
-        self._db.set(__name__, "gone", None)
-        self._db.set(__name__, "ratelimit", [])
+        self._afk = False
+        self._gone = None
+        self._ratelimit.clear()
+        self.save()
         await self.allmodules.log("unafk")
         await utils.answer(message, self.strings("back", message))
 
@@ -65,20 +79,19 @@ class AFKMod(loader.Module):
             if not afk_state:
                 return
             logger.debug("tagged!")
-            ratelimit = self._db.get(__name__, "ratelimit", [])
-            if utils.get_chat_id(message) in ratelimit:
+            if utils.get_chat_id(message) in self._ratelimit:
                 return
             else:
-                self._db.setdefault(__name__, {}).setdefault("ratelimit", []).append(utils.get_chat_id(message))
-                self._db.save()
-            user = await utils.get_user(message)
+                self._ratelimit.add(utils.get_chat_id(message))
+                self.save_later()
+            user = await self._users.get(message)
             if user.is_self or user.bot or user.verified:
                 logger.debug("User is self, bot or verified.")
                 return
             if self.get_afk() is False:
                 return
             now = datetime.datetime.now().replace(microsecond=0)
-            gone = datetime.datetime.fromtimestamp(self._db.get(__name__, "gone")).replace(microsecond=0)
+            gone = datetime.datetime.fromtimestamp(self._gone).replace(microsecond=0)
             diff = now - gone
             if afk_state is True:
                 ret = self.strings("afk", message).format(diff)
@@ -87,4 +100,66 @@ class AFKMod(loader.Module):
             await utils.answer(message, ret, reply_to=message)
 
     def get_afk(self):
-        return self._db.get(__name__, "afk", False)
+        return self._afk
+
+    def save(self):
+        """Writes the AFK state to the database in a single save, dropping any pending delayed save"""
+        if self._flush is not None:
+            self._flush.cancel()
+            self._flush = None
+        self._db.setdefault(__name__, {}).update(afk=self._afk, gone=self._gone, ratelimit=list(self._ratelimit))
+        self._db.save()
+
+    def save_later(self):
+        if self._flush is None:
+            self._flush = asyncio.ensure_future(self._save_after(self.config["FLUSH_INTERVAL"]))
+
+    async def _save_after(self, delay):
+        await asyncio.sleep(delay)
+        self._flush = None
+        self.save()
+
+
+UserFlags = collections.namedtuple("UserFlags", ["is_self", "bot", "verified"])
+
+
+class UserFlagCache:
+    """Bounded TTL cache of the is_self/bot/verified flags of message senders, keyed by user id.
+       Filled from the sender entity attached to the update, falls back to one lookup on a miss"""
+
+    def __init__(self, size=4096, ttl=3600):
+        self._cache = collections.OrderedDict()
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def shared(cls, client):
+        """The cache of the client, created on first use. It is kept on the client, so every module
+           with a copy of this class uses the same one, and accounts don't mix up their flags"""
+        cache = getattr(client, "_user_flag_cache", None)
+        if cache is None:
+            cache = client._user_flag_cache = cls()
+        return cache
+
+    async def get(self, message):
+        user_id = message.sender_id
+        entry = self._cache.get(user_id)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._cache.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        logger.debug("User flag cache miss for %s (%d hits, %d misses)", user_id, self.hits, self.misses)
+        user = message.sender
+        if user is None:
+            user = await utils.get_user(message)
+        flags = UserFlags(bool(getattr(user, "is_self", False)), bool(getattr(user, "bot", False)),
+                          bool(getattr(user, "verified", False)))
+        if user_id is not None:
+            self._cache[user_id] = (time.monotonic(), flags)
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        return flags
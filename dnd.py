@@ -17,6 +17,8 @@
 
 from .. import loader, utils
 
+import asyncio
+import collections
 import logging
 import datetime
 import time
@@ -51,6 +53,8 @@ class DoNotDisturbMod(loader.Module):
                "afk_reason": ("<b>I'm AFK right now (since {} ago).</b>"
                               "\n\n<b>Reason :</b> <i>{}</i>"),
                "arg_on_off": "<b>Argument must be 'off' or 'on' !</b>",
+               "decay_cfg_doc": "Seconds after which a user's PM count drops by one, or 0 to never forget",
+               "flush_cfg_doc": "Seconds to batch PM count changes for before they are saved",
                "pm_off": ("<b>Automatic answer for denied PMs disabled."
                           "\n\nUsers are now free to PM !</b>"),
                "pm_on": "<b>An automatic answer is now sent for denied PMs.</b>",
@@ -86,13 +90,18 @@ class DoNotDisturbMod(loader.Module):
                "who_to_unblock": "<b>Specify who to unblock.</b>"}
 
     def __init__(self):
-        self._me = None
+        self._users = None
+        self.config = loader.ModuleConfig("PM_DECAY", 3600, lambda m: self.strings("decay_cfg_doc", m),
+                                          "FLUSH_INTERVAL", 10, lambda m: self.strings("flush_cfg_doc", m))
         self.default_pm_limit = 50
+        self._pms = None
+        self._flush = None
 
     async def client_ready(self, client, db):
         self._db = db
+        self._users = UserFlagCache.shared(client)
         self._client = client
-        self._me = await client.get_me(True)
+        self._pms = DecayingCounter(self._db.get(__name__, "pms", {}), self.config["PM_DECAY"])
 
     async def unafkcmd(self, message):
         """Remove the AFK status.\n """
@@ -386,61 +395,165 @@ class DoNotDisturbMod(loader.Module):
         await utils.answer(message, self.strings("pm_unblocked", message).format(user))
 
     async def watcher(self, message):
-        user = await utils.get_user(message)
+        # Cheap checks first, the sender is only resolved once we know we might answer
+        if not isinstance(message, types.Message):
+            return
+        # Incoming PMs carry the sender as peer on current Telethon, so to_id can't be compared with our id
+        is_pm = message.is_private and not message.out
+        if not is_pm and not message.mentioned:
+            return
         pm = self._db.get(__name__, "pm")
-        if getattr(message.to_id, "user_id", None) == self._me.user_id and (pm is None or pm is False):
-            if not user.is_self and not user.bot and not user.verified and not self.get_allowed(message.from_id):
-                await utils.answer(message, self.strings("pm_go_away",message))
-                if self._db.get(__name__, "pm_limit") is True:
-                    pms = self._db.get(__name__, "pms", {})
-                    pm_limit = self._db.get(__name__, "pm_limit_max")
-                    pm_user = pms.get(message.from_id, 0)
-                    if isinstance(pm_limit, int) and pm_limit >= 5 and pm_limit <= 1000 and pm_user >= pm_limit:
-                        await utils.answer(message, self.strings("pm_triggered", message))
-                        await message.client(functions.contacts.BlockRequest(message.from_id))
-                        await message.client(functions.messages.ReportSpamRequest(peer=message.from_id))
-                        del pms[message.from_id]
-                        self._db.set(__name__, "pms", pms)
-                    else:
-                        self._db.set(__name__, "pms", {**pms, message.from_id: pms.get(message.from_id, 0) + 1})
-                pm_notif = self._db.get(__name__, "pm_notif")
-                if pm_notif is None or pm_notif is False:
-                    await message.client.send_read_acknowledge(message.chat_id)
-                return
-        if message.mentioned or getattr(message.to_id, "user_id", None) == self._me.user_id:
-            afk_status = self._db.get(__name__, "afk")
-            if user.is_self or user.bot or user.verified or afk_status is False:
-                return
-            if message.mentioned and self._db.get(__name__, "afk_no_group") is True:
-                return
-            afk_no_pm = self._db.get(__name__, "afk_no_pm")
-            if getattr(message.to_id, "user_id", None) == self._me.user_id and afk_no_pm is True:
-                return
-            if self._db.get(__name__, "afk_rate_limit") is True:
-                afk_rate = self._db.get(__name__, "afk_rate", [])
-                if utils.get_chat_id(message) in afk_rate:
-                    return
+        deny_pm = is_pm and (pm is None or pm is False) and not self.get_allowed(message.sender_id)
+        afk_status = self._db.get(__name__, "afk")
+        afk = (afk_status is not None and afk_status is not False
+               and not (message.mentioned and self._db.get(__name__, "afk_no_group") is True)
+               and not (is_pm and self._db.get(__name__, "afk_no_pm") is True))
+        afk_rate_limit = self._db.get(__name__, "afk_rate_limit") is True
+        if afk and afk_rate_limit and utils.get_chat_id(message) in self._db.get(__name__, "afk_rate", []):
+            afk = False
+        if not deny_pm and not afk:
+            return
+        user = await self._users.get(message)
+        if user.is_self or user.bot or user.verified:
+            return
+        if deny_pm:
+            await utils.answer(message, self.strings("pm_go_away", message))
+            if self._db.get(__name__, "pm_limit") is True:
+                pm_limit = self._db.get(__name__, "pm_limit_max")
+                pm_user = self._pms.get(message.sender_id)
+                if isinstance(pm_limit, int) and pm_limit >= 5 and pm_limit <= 1000 and pm_user >= pm_limit:
+                    await utils.answer(message, self.strings("pm_triggered", message))
+                    await message.client(functions.contacts.BlockRequest(message.sender_id))
+                    await message.client(functions.messages.ReportSpamRequest(peer=message.sender_id))
+                    self._pms.pop(message.sender_id)
+                    self.save_pms()
                 else:
-                    self._db.setdefault(__name__, {}).setdefault("afk_rate", []).append(utils.get_chat_id(message))
-                    self._db.save()
-            now = datetime.datetime.now().replace(microsecond=0)
-            gone = datetime.datetime.fromtimestamp(self._db.get(__name__, "afk_gone")).replace(microsecond=0)
-            diff = now - gone
-            if afk_status is True:
-                afk_message = self.strings("afk", message).format(diff)
-            elif afk_status is not False:
-                afk_message = self.strings("afk_reason", message).format(diff, afk_status)
-            await utils.answer(message, afk_message)
-            afk_notif = self._db.get(__name__, "afk_notif")
-            if afk_notif is None or afk_notif is False:
+                    self._pms.increment(message.sender_id)
+                    self.save_pms_later()
+            pm_notif = self._db.get(__name__, "pm_notif")
+            if pm_notif is None or pm_notif is False:
                 await message.client.send_read_acknowledge(message.chat_id)
+            return
+        if afk_rate_limit:
+            self._db.setdefault(__name__, {}).setdefault("afk_rate", []).append(utils.get_chat_id(message))
+            self._db.save()
+        now = datetime.datetime.now().replace(microsecond=0)
+        gone = datetime.datetime.fromtimestamp(self._db.get(__name__, "afk_gone")).replace(microsecond=0)
+        diff = now - gone
+        if afk_status is True:
+            afk_message = self.strings("afk", message).format(diff)
+        else:
+            afk_message = self.strings("afk_reason", message).format(diff, afk_status)
+        await utils.answer(message, afk_message)
+        afk_notif = self._db.get(__name__, "afk_notif")
+        if afk_notif is None or afk_notif is False:
+            await message.client.send_read_acknowledge(message.chat_id)
 
     def get_allowed(self, id):
         return id in self._db.get(__name__, "allow", [])
 
+    def save_pms(self):
+        if self._flush is not None:
+            self._flush.cancel()
+            self._flush = None
+        self._db.set(__name__, "pms", self._pms.dump())
+
+    def save_pms_later(self):
+        if self._flush is None:
+            self._flush = asyncio.ensure_future(self._save_pms_after(self.config["FLUSH_INTERVAL"]))
+
+    async def _save_pms_after(self, delay):
+        await asyncio.sleep(delay)
+        self._flush = None
+        self.save_pms()
+
     def get_current_pm_limit(self):
         pm_limit = self._db.get(__name__, "pm_limit_max")
         if not isinstance(pm_limit, int) or pm_limit < 5 or pm_limit > 1000:
             pm_limit = self.default_pm_limit
             self._db.set(__name__, "pm_limit_max", pm_limit)
         return pm_limit
+
+
+class DecayingCounter:
+    """In-memory PM counters per user. A count drops by one for every decay seconds that pass,
+       so old offenders eventually start from zero again"""
+
+    def __init__(self, counts, decay):
+        now = time.time()
+        # Counts used to be saved under the sender's from_id, which is None ("null" in JSON) for most PMs
+        self._counts = {int(key): list(value) if isinstance(value, list) else [value, now]
+                        for key, value in counts.items() if str(key).lstrip("-").isdigit()}
+        self.decay = decay
+
+    def get(self, key):
+        entry = self._counts.get(key)
+        if entry is None:
+            return 0
+        if self.decay:
+            steps = int((time.time() - entry[1]) // self.decay)
+            if steps:
+                entry[0] -= steps
+                entry[1] += steps * self.decay
+                if entry[0] <= 0:
+                    del self._counts[key]
+                    return 0
+        return entry[0]
+
+    def increment(self, key):
+        count = self.get(key) + 1
+        self._counts.setdefault(key, [0, time.time()])[0] = count
+        return count
+
+    def pop(self, key):
+        self._counts.pop(key, None)
+
+    def dump(self):
+        for key in list(self._counts):
+            self.get(key)
+        return {key: list(value) for key, value in self._counts.items()}
+
+
+UserFlags = collections.namedtuple("UserFlags", ["is_self", "bot", "verified"])
+
+
+class UserFlagCache:
+    """Bounded TTL cache of the is_self/bot/verified flags of message senders, keyed by user id.
+       Filled from the sender entity attached to the update, falls back to one lookup on a miss"""
+
+    def __init__(self, size=4096, ttl=3600):
+        self._cache = collections.OrderedDict()
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def shared(cls, client):
+        """The cache of the client, created on first use. It is kept on the client, so every module
+           with a copy of this class uses the same one, and accounts don't mix up their flags"""
+        cache = getattr(client, "_user_flag_cache", None)
+        if cache is None:
+            cache = client._user_flag_cache = cls()
+        return cache
+
+    async def get(self, message):
+        user_id = message.sender_id
+        entry = self._cache.get(user_id)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._cache.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        logger.debug("User flag cache miss for %s (%d hits, %d misses)", user_id, self.hits, self.misses)
+        user = message.sender
+        if user is None:
+            user = await utils.get_user(message)
+        flags = UserFlags(bool(getattr(user, "is_self", False)), bool(getattr(user, "bot", False)),
+                          bool(getattr(user, "verified", False)))
+        if user_id is not None:
+            self._cache[user_id] = (time.monotonic(), flags)
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        return flags
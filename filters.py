@@ -15,8 +15,16 @@
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from .. import loader, utils
+import asyncio
+import collections
 import functools
-from telethon import events
+import json
+import os
+import re
+import tempfile
+import time
+import zipfile
+from telethon import events, types
 import logging
 
 logger = logging.getLogger("FilterModule")
@@ -25,16 +33,28 @@ logger = logging.getLogger("FilterModule")
 @loader.tds
 class FiltersMod(loader.Module):
     """When you filter a text, it auto responds to it if a user triggers the word)"""
-    strings = {"name": "Filters"}
+    strings = {"name": "Filters",
+               "cache_size_cfg_doc": "How many fetched filter replies to keep in memory",
+               "cache_ttl_cfg_doc": "Seconds a cached filter reply stays valid, 0 to keep until evicted",
+               "import_concurrency_cfg_doc": "How many filters .importfilters stores at the same time"}
 
     def __init__(self):
+        self.config = loader.ModuleConfig("ASSET_CACHE_SIZE", 128, lambda m: self.strings("cache_size_cfg_doc", m),
+                                          "ASSET_CACHE_TTL", 3600, lambda m: self.strings("cache_ttl_cfg_doc", m),
+                                          "IMPORT_CONCURRENCY", 4,
+                                          lambda m: self.strings("import_concurrency_cfg_doc", m))
         self._me = None
         self._ratelimit = []
+        self._index = {}
 
     async def client_ready(self, client, db):
         self._db = db
         self._client = client
         self._me = await client.get_me()
+        self._assets = AssetCache(db, self.config["ASSET_CACHE_SIZE"], self.config["ASSET_CACHE_TTL"])
+        modes = self._db.get("FilterModule", "modes", {})
+        self._index = {chatid: TriggerIndex(keys, modes.get(chatid, {}))
+                       for chatid, keys in self._db.get("FilterModule", "filters", {}).items()}
         if "Filters.watchout" not in str(client.list_event_handlers()):
             client.add_event_handler(
                 functools.partial(self.watchout),
@@ -61,8 +81,12 @@ class FiltersMod(loader.Module):
         else:
             value = await message.get_reply_message()
             msg_to_log = await self._db.store_asset(value)
+        if name in filters[chatid]:
+            self._assets.invalidate(filters[chatid][name])
         filters[chatid][name] = msg_to_log
         self._db.set("FilterModule", "filters", filters)
+        mode = self._db.get("FilterModule", "modes", {}).get(chatid, {}).get(name, "word")
+        self._index.setdefault(chatid, TriggerIndex()).add(name, mode)
         await message.edit((
             "<b>Successfully filtered.</b>".format(name)))
         message.message = ""
@@ -76,7 +100,9 @@ class FiltersMod(loader.Module):
             await message.edit(("<b>Please specify the name of the filter.</b>"))
             return
         try:
-            del filters[chatid][filtern]
+            self._assets.invalidate(filters[chatid].pop(filtern))
+            self._index[chatid].discard(filtern)
+            self._set_mode(chatid, filtern, "word")
             await message.edit(("<b>Filter </b><i>{}</i><b> successfully removed from the chat.</b>".format(filtern)))
             self._db.set("FilterModule", "filters", filters)
         except KeyError:
@@ -87,21 +113,62 @@ class FiltersMod(loader.Module):
         filters = self._db.get("FilterModule", "filters", {})
         chatid = str(message.chat_id)
         try:
-            del filters[chatid]
+            for asset_id in filters.pop(chatid).values():
+                self._assets.invalidate(asset_id)
+            self._index.pop(chatid, None)
+            self._db.get("FilterModule", "modes", {}).pop(chatid, None)
             self._db.set("FilterModule", "filters", filters)
             await message.edit(("<b>All filters successfully removed from the chat.</b>"))
         except KeyError:
             await message.edit(("<b>There are no filters to clear out in this chat.</b>"))
 
+    async def filtermodecmd(self, message):
+        """Sets how a filter is matched: .filtermode <name>, <word|substring|nocase|regex>"""
+        args = utils.get_args_split_by(message, ",")
+        chatid = str(message.chat_id)
+        filters = self._db.get("FilterModule", "filters", {})
+        if len(args) != 2 or args[1] not in TriggerIndex.MODES:
+            await message.edit(("<b>Usage: </b><code>.filtermode name, word|substring|nocase|regex</code>"))
+            return
+        name, mode = args
+        if name not in filters.get(chatid, {}):
+            await message.edit(("<b>Filter </b><i>{}</i><b> not found in this chat</b>".format(name)))
+            return
+        if mode == "regex":
+            try:
+                re.compile(name)
+            except re.error as e:
+                await message.edit(("<b>Invalid regex: </b><code>{}</code>".format(utils.escape_html(str(e)))))
+                return
+        self._set_mode(chatid, name, mode)
+        self._index[chatid].discard(name)
+        self._index[chatid].add(name, mode)
+        await message.edit(("<b>Filter </b><i>{}</i><b> now matches as {}.</b>".format(name, mode)))
+
+    def _set_mode(self, chatid, name, mode):
+        modes = self._db.get("FilterModule", "modes", {})
+        if mode == "word":
+            if name not in modes.get(chatid, {}):
+                return
+            del modes[chatid][name]
+            if not modes[chatid]:
+                del modes[chatid]
+        else:
+            modes.setdefault(chatid, {})[name] = mode
+        self._db.set("FilterModule", "modes", modes)
+
     async def filterscmd(self, message):
         """Shows saved filters."""
         filters = ""
         filt = self._db.get("FilterModule", "filters", {})
         chatid = str(message.chat_id)
+        modes = self._db.get("FilterModule", "modes", {}).get(chatid, {})
         try:
             for i in filt[chatid]:
-                filters += "<b> -  " + str(i) + "</b>\n"
-                pass
+                filters += "<b> -  " + str(i) + "</b>"
+                if i in modes:
+                    filters += " <i>(" + modes[i] + ")</i>"
+                filters += "\n"
         except Exception:
             pass
         filterl = "<b>Word(s) that you filtered in this chat: </b>\n\n{}".format(filters)
@@ -110,17 +177,95 @@ class FiltersMod(loader.Module):
         else:
             await message.edit(("<b>No filters found in this chat.</b>"))
 
-    async def watchout(self, message):
+    async def exportfilterscmd(self, message):
+        """Sends the filters of this chat, text and media, as one zip archive"""
+        chatid = str(message.chat_id)
+        filters = self._db.get("FilterModule", "filters", {}).get(chatid, {})
+        modes = self._db.get("FilterModule", "modes", {}).get(chatid, {})
+        if not filters:
+            await message.edit(("<b>No filters found in this chat.</b>"))
+            return
+        await message.edit(("<b>Exporting filters...</b>"))
+        with tempfile.TemporaryDirectory() as path:
+            manifest = []
+            with zipfile.ZipFile(os.path.join(path, "filters.zip"), "w", zipfile.ZIP_DEFLATED) as archive:
+                for name, asset_id in list(filters.items()):
+                    asset = await self._db.fetch_asset(asset_id)
+                    entry = await dump_message(archive, asset, name) if asset is not None else None
+                    if entry is not None:
+                        entry["mode"] = modes.get(name, "word")
+                        manifest.append(entry)
+                archive.writestr("filters.json", json.dumps(manifest))
+            await message.client.send_file(message.chat_id, os.path.join(path, "filters.zip"), force_document=True)
+        await message.edit(("<b>Exported {} filters.</b>".format(len(manifest))))
+
+    async def importfilterscmd(self, message):
+        """Restores filters into this chat from an archive made by .exportfilters. Must be used in reply to it"""
+        reply = await message.get_reply_message()
+        chatid = str(message.chat_id)
+        if not reply or not reply.file:
+            await message.edit(("<b>Reply to an archive made by .exportfilters</b>"))
+            return
+        await message.edit(("<b>Importing filters...</b>"))
+        semaphore = asyncio.Semaphore(max(self.config["IMPORT_CONCURRENCY"], 1))
+
+        async def restore(entry):
+            async with semaphore:
+                mode = entry.get("mode", "word")
+                if mode not in TriggerIndex.MODES:
+                    mode = "word"
+                elif mode == "regex":
+                    try:
+                        re.compile(entry["name"])
+                    except re.error:
+                        mode = "word"
+                try:
+                    target = load_message(archive, entry, path)
+                except KeyError as e:
+                    logger.warning("Skipping filter %s, invalid entry: %s", entry.get("name"), e)
+                    return None
+                try:
+                    return entry["name"], mode, await self._db.store_asset(target)
+                except ValueError as e:
+                    logger.warning("Skipping filter %s: %s", entry["name"], e)
+                    return None
+                finally:
+                    if target.media:
+                        os.remove(target.media)
+
+        with tempfile.TemporaryDirectory() as path:
+            try:
+                archive = zipfile.ZipFile(await reply.download_media(file=os.path.join(path, "filters.zip")))
+                manifest = json.loads(archive.read("filters.json"))
+            except (zipfile.BadZipFile, KeyError, ValueError):
+                await message.edit(("<b>This is not a filters archive</b>"))
+                return
+            with archive:
+                restored = [ret for ret in await asyncio.gather(*(restore(entry) for entry in manifest))
+                            if ret is not None]
         filters = self._db.get("FilterModule", "filters", {})
-        args = message.text.split(" ")
-        exec = True
+        index = self._index.setdefault(chatid, TriggerIndex())
+        for name, mode, asset_id in restored:
+            if name in filters.setdefault(chatid, {}):
+                self._assets.invalidate(filters[chatid][name])
+                index.discard(name)
+            filters[chatid][name] = asset_id
+            self._set_mode(chatid, name, mode)
+            index.add(name, mode)
+        self._db.set("FilterModule", "filters", filters)
+        await message.edit(("<b>Imported {} filters.</b>".format(len(restored))))
+
+    async def watchout(self, message):
         chatid = str(message.chat_id)
-        if chatid not in str(filters):
+        index = self._index.get(chatid)
+        if not index:
             return
-        for key in filters[chatid]:
-            if key in args:
+        filters = self._db.get("FilterModule", "filters", {})
+        exec = True
+        for key in index.match(message.text):
+            if key in filters.get(chatid, {}):
                 id = filters[chatid][key]
-                value = await self._db.fetch_asset(id)
+                value = await self._assets.fetch(id)
                 if not value.media and not value.web_preview:
                     if value.text.startswith(".") is True:
                         arg = value.text[1::]
@@ -136,3 +281,203 @@ class FiltersMod(loader.Module):
                         await cmd(respond)
                 else:
                     await message.reply(value)
+
+
+class AssetCache:
+    """Bounded LRU cache of fetched asset messages, keyed by asset id, with TTL expiry"""
+
+    def __init__(self, db, size, ttl):
+        self._db = db
+        self._cache = collections.OrderedDict()
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    async def fetch(self, asset_id):
+        entry = self._cache.get(asset_id)
+        if entry is not None and (not self.ttl or time.monotonic() - entry[0] < self.ttl):
+            self._cache.move_to_end(asset_id)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        logger.debug("Asset cache miss for %s (%d hits, %d misses)", asset_id, self.hits, self.misses)
+        value = await self._db.fetch_asset(asset_id)
+        if value is None:
+            self._cache.pop(asset_id, None)
+            return None
+        self._cache[asset_id] = (time.monotonic(), value)
+        self._cache.move_to_end(asset_id)
+        while len(self._cache) > max(self.size, 0):
+            self._cache.popitem(last=False)
+        return value
+
+    def invalidate(self, asset_id):
+        self._cache.pop(asset_id, None)
+
+    def clear(self):
+        self._cache.clear()
+
+
+async def dump_message(archive, message, name):
+    """Writes the media of message into archive, streaming it, and returns its manifest entry,
+       or None if there is nothing that can be exported"""
+    entry = {"name": name, "text": message.message or "",
+             "entities": [entity.to_dict() for entity in message.entities or []]}
+    if message.file is not None and not isinstance(message.media, types.MessageMediaWebPage):
+        entry["file"] = "media/{}{}".format(message.id, message.file.ext or "")
+        with archive.open(entry["file"], "w", force_zip64=True) as file:
+            await message.download_media(file=file)
+    elif message.media and not isinstance(message.media, types.MessageMediaWebPage):
+        # Locations, contacts, polls and dice have no file to archive
+        if not entry["text"]:
+            logger.warning("Skipping %s, its %s can't be exported", name, type(message.media).__name__)
+            return None
+        logger.info("Exporting %s as text only, its %s can't be exported", name, type(message.media).__name__)
+    return entry
+
+
+def load_message(archive, entry, path):
+    """Builds an unsent message from a manifest entry, extracting its media under path"""
+    media = archive.extract(entry["file"], path) if entry.get("file") else None
+    return types.Message(0, None, None, entry["text"], entities=load_entities(entry["entities"]) or None,
+                         media=media)
+
+
+def load_entities(entities):
+    ret = []
+    for entity in entities:
+        entity = dict(entity)
+        cls = getattr(types, entity.pop("_"), None)
+        if cls is not None:
+            ret.append(cls(**entity))
+    return ret
+
+
+class TriggerIndex:
+    """Filter triggers of one chat, matched against a message without looping over every filter.
+       Word triggers live in a set (single words) or an Aho-Corasick automaton over words (phrases),
+       every other mode is checked per filter with the cheapest test that mode allows"""
+    MODES = ("word", "substring", "nocase", "regex")
+
+    def __init__(self, keys=(), modes=None):
+        self.words = set()
+        self.phrases = set()
+        self.patterns = {}
+        self._goto = None
+        self._regexes = None
+        for key in keys:
+            self.add(key, (modes or {}).get(key, "word"))
+
+    def __len__(self):
+        return len(self.words) + len(self.phrases) + len(self.patterns)
+
+    def add(self, key, mode="word"):
+        if mode != "word":
+            self.patterns[key] = mode
+            self._regexes = None
+        elif " " in key:
+            self.phrases.add(key)
+            self._goto = None
+        else:
+            self.words.add(key)
+
+    def discard(self, key):
+        if key in self.patterns:
+            del self.patterns[key]
+            self._regexes = None
+        elif key in self.phrases:
+            self.phrases.discard(key)
+            self._goto = None
+        else:
+            self.words.discard(key)
+
+    def _build(self):
+        # Automaton is rebuilt lazily, and only when the set of phrases changed
+        goto, fail, out = [{}], [0], [[]]
+        for phrase in self.phrases:
+            node = 0
+            for word in phrase.split(" "):
+                if word not in goto[node]:
+                    goto[node][word] = len(goto)
+                    goto.append({})
+                    fail.append(0)
+                    out.append([])
+                node = goto[node][word]
+            out[node].append(phrase)
+        queue = collections.deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for word, child in goto[node].items():
+                queue.append(child)
+                state = fail[node]
+                while state and word not in goto[state]:
+                    state = fail[state]
+                fail[child] = goto[state].get(word, 0)
+                out[child] = out[child] + out[fail[child]]
+        self._goto, self._fail, self._out = goto, fail, out
+
+    def _compile(self):
+        # Every pattern is checked on its own, so a regex behaves exactly as it did when it was validated,
+        # an invalid one only disables itself and overlapping triggers (cat, category) all fire.
+        # Substring and nocase triggers are found with plain "in" scans, regexes are only run for nocase hits
+        self._regexes = []
+        self._substrings = []
+        self._nocase = []
+        for key, mode in self.patterns.items():
+            if mode == "substring":
+                if key:
+                    self._substrings.append(key)
+                continue
+            if mode == "nocase":
+                pattern = "(?i)(?<![^ ])" + re.escape(key) + "(?![^ ])"
+            else:
+                pattern = key
+            try:
+                regex = re.compile(pattern)
+            except re.error as e:
+                logger.warning("Skipping filter %r, invalid regex: %s", key, e)
+                continue
+            if mode == "nocase":
+                self._nocase.append((key, key.lower(), regex))
+            else:
+                self._regexes.append((key, regex))
+
+    def match(self, text):
+        """Returns the triggers found in the text, words first, then patterns in order of appearance"""
+        found = {}
+        if self.phrases and self._goto is None:
+            self._build()
+        node = 0
+        for word in text.split(" "):
+            if word in self.words:
+                found[word] = None
+            if self.phrases:
+                while node and word not in self._goto[node]:
+                    node = self._fail[node]
+                node = self._goto[node].get(word, 0)
+                for phrase in self._out[node]:
+                    found[phrase] = None
+        if self.patterns:
+            if self._regexes is None:
+                self._compile()
+            hits = []
+            for key in self._substrings:
+                pos = text.find(key)
+                if pos >= 0:
+                    hits.append((pos, key))
+            if self._nocase:
+                lowered = text.lower()
+                for key, lowered_key, regex in self._nocase:
+                    if lowered_key in lowered:
+                        match = regex.search(text)
+                        if match:
+                            hits.append((match.start(), key))
+            for key, regex in self._regexes:
+                for match in regex.finditer(text):
+                    if match.group():
+                        hits.append((match.start(), key))
+                        break
+            for _, key in sorted(hits, key=lambda hit: hit[0]):
+                found[key] = None
+        return list(found)
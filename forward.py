@@ -14,37 +14,235 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
+import datetime
 import logging
+import time
+
+from telethon.errors import FloodWaitError
+from telethon.tl.types import (InputMessagesFilterDocument, InputMessagesFilterPhotos, InputMessagesFilterUrl,
+                               InputMessagesFilterVideo)
 
 from .. import loader, utils
 
 logger = logging.getLogger(__name__)
 
+MEDIA_FILTERS = {"photos": InputMessagesFilterPhotos,
+                 "documents": InputMessagesFilterDocument,
+                 "videos": InputMessagesFilterVideo,
+                 "links": InputMessagesFilterUrl}
+
 
 @loader.tds
 class ForwardMod(loader.Module):
     """Forwards messages"""
     strings = {"name": "Forwarding",
                "error": "<b>Invalid chat to forward to</b>",
-               "done": "<b>Forwarded all messages</b>"}
+               "bad_filter": "<b>Invalid filter</b> <code>{}</code>",
+               "done": "<b>Forwarded all messages</b>",
+               "resume_none": "<b>There is no unfinished forwarding job to resume</b>",
+               "running": "<b>A forwarding job is already running, see .fwdall status</b>",
+               "status_none": "<b>No forwarding job was started yet</b>",
+               "status": "<b>Forwarded {} of {} messages ({}%)</b>\n<b>Last message ID:</b> <code>{}</code>\n{}",
+               "status_eta": "<b>ETA:</b> {}",
+               "status_paused": "<b>Paused, use</b> <code>.fwdall resume</code> <b>to continue</b>",
+               "status_done": "<b>Finished</b>"}
+
+    def __init__(self):
+        self._running = None
+
+    async def client_ready(self, client, db):
+        self._db = db
 
     async def fwdallcmd(self, message):
-        """.fwdall <to_user>
-           Forwards all messages in chat"""
+        """.fwdall <to_user> [since=YYYY-MM-DD] [until=YYYY-MM-DD] [min_id=N] [max_id=N] [from=user]
+                  [type=photos|documents|videos|links]
+           Forwards all messages in chat, or only those matching the filters (dates are UTC, both days included)
+           .fwdall resume : continue the last job from its checkpoint
+           .fwdall status : show progress of the last job"""
+        args = utils.get_args(message)
+        job = self._db.get(__name__, "job", None)
+        if args and args[0] == "status":
+            await utils.answer(message, self.get_status(job, message))
+            return
+        if self._running is not None:
+            await utils.answer(message, self.strings("running", message))
+            return
+        if args and args[0] == "resume":
+            if not job or job["finished"]:
+                await utils.answer(message, self.strings("resume_none", message))
+                return
+        else:
+            to = args.pop(0) if args and "=" not in args[0] else None
+            try:
+                filters = parse_filters(args)
+                kwargs = await search_kwargs(message.client, filters, 0)
+            except (ValueError, TypeError) as e:
+                await utils.answer(message, self.strings("bad_filter", message).format(utils.escape_html(str(e))))
+                return
+            total = (await message.client.get_messages(message.to_id, limit=0, **kwargs)).total
+            job = {"from": message.chat_id, "to": to, "filters": filters, "last_id": 0, "done": 0,
+                   "total": total, "finished": False}
         try:
-            user = await message.client.get_input_entity(utils.get_args(message)[0])
-        except ValueError:
-            await utils.answer(self.strings("error", message))
-        msgs = []
-        async for msg in message.client.iter_messages(
-                entity=message.to_id,
-                reverse=True):
-            msgs += [msg.id]
-            if len(msgs) >= 100:
-                logger.debug(msgs)
-                await message.client.forward_messages(user, msgs, message.from_id)
-                msgs = []
-        if len(msgs) > 0:
-            logger.debug(msgs)
-            await message.client.forward_messages(user, msgs, message.from_id)
+            user = await message.client.get_input_entity(job["to"])
+        except (ValueError, TypeError):
+            await utils.answer(message, self.strings("error", message))
+            return
+        self._db.set(__name__, "job", job)
+        self._running = (time.time(), job["done"])
+        try:
+            await self.run_job(message.client, user, job)
+        finally:
+            self._running = None
         await utils.answer(message, self.strings("done", message))
+
+    async def run_job(self, client, user, job):
+        """Forwards everything after the checkpoint, saving it after every batch.
+           The next pages are fetched in the background while the current batch is forwarded"""
+        queue = asyncio.Queue(3)
+        prefetch = asyncio.ensure_future(self._prefetch(client, job, queue))
+        pacer = Pacer()
+        try:
+            while True:
+                msgs = await queue.get()
+                if msgs is None:
+                    break
+                if isinstance(msgs, Exception):
+                    raise msgs
+                await self._forward_batch(client, user, job, msgs, pacer)
+        finally:
+            prefetch.cancel()
+        job["finished"] = True
+        self._db.set(__name__, "job", job)
+
+    async def _prefetch(self, client, job, queue):
+        msgs = []
+        filters = job.get("filters", {})
+        until = filters.get("until")
+        try:
+            kwargs = await search_kwargs(client, filters, job["last_id"])
+            async for msg in client.iter_messages(entity=job["from"], reverse=True, **kwargs):
+                if until is not None and msg.date.timestamp() >= until:
+                    # Oldest first, so nothing later can match; at most one page past the range is fetched
+                    break
+                msgs += [msg.id]
+                if len(msgs) >= 100:
+                    await queue.put(msgs)
+                    msgs = []
+            if len(msgs) > 0:
+                await queue.put(msgs)
+        except Exception as e:
+            # Handed over to the forwarder, which raises it once the batches before it are sent
+            await queue.put(e)
+            return
+        await queue.put(None)
+
+    async def _forward_batch(self, client, user, job, msgs, pacer):
+        logger.debug(msgs)
+        while True:
+            await pacer.wait()
+            try:
+                await client.forward_messages(user, msgs, job["from"])
+            except FloodWaitError as e:
+                pacer.flood(e.seconds)
+                logger.debug("Flood wait of %d seconds, now forwarding every %.2f seconds", e.seconds, pacer.interval)
+                await asyncio.sleep(e.seconds)
+            else:
+                pacer.success()
+                break
+        job["last_id"] = msgs[-1]
+        job["done"] += len(msgs)
+        self._db.set(__name__, "job", job)
+
+    def get_status(self, job, message):
+        if not job:
+            return self.strings("status_none", message)
+        if job["finished"]:
+            state = self.strings("status_done", message)
+        elif self._running is None:
+            state = self.strings("status_paused", message)
+        else:
+            started, done = self._running
+            rate = (job["done"] - done) / max(time.time() - started, 1)
+            eta = datetime.timedelta(seconds=int((job["total"] - job["done"]) / rate)) if rate else "?"
+            state = self.strings("status_eta", message).format(eta)
+        percent = min(100 * job["done"] // max(job["total"], 1), 100)
+        return self.strings("status", message).format(job["done"], job["total"], percent, job["last_id"], state)
+
+
+def parse_filters(args):
+    """Turns key=value arguments into a JSON serialisable filter dict, raising ValueError on bad input"""
+    filters = {}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep or not value:
+            raise ValueError(arg)
+        if key in ("since", "until"):
+            try:
+                date = datetime.datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                raise ValueError(arg)
+            if key == "until":
+                # Stored as the exclusive end, so the whole until day is included
+                date += datetime.timedelta(days=1)
+            filters[key] = int(date.replace(tzinfo=datetime.timezone.utc).timestamp())
+        elif key in ("min_id", "max_id"):
+            if not value.isdigit():
+                raise ValueError(arg)
+            filters[key] = int(value)
+        elif key == "from":
+            filters[key] = int(value) if value.lstrip("-").isdigit() else value
+        elif key == "type":
+            if value not in MEDIA_FILTERS:
+                raise ValueError(arg)
+            filters[key] = value
+        else:
+            raise ValueError(arg)
+    return filters
+
+
+async def search_kwargs(client, filters, last_id):
+    """Maps the stored filters onto iter_messages arguments so the server does the filtering.
+       The upper date bound has no server side equivalent when iterating oldest first, so the caller stops on it"""
+    kwargs = {"min_id": max(filters.get("min_id", 0), last_id)}
+    if "max_id" in filters:
+        kwargs["max_id"] = filters["max_id"]
+    if "since" in filters and not last_id:
+        # Once there is a checkpoint, min_id already lies past the start date
+        kwargs["offset_date"] = datetime.datetime.fromtimestamp(filters["since"], datetime.timezone.utc)
+    if "from" in filters:
+        kwargs["from_user"] = await client.get_input_entity(filters["from"])
+    if "type" in filters:
+        kwargs["filter"] = MEDIA_FILTERS[filters["type"]]
+    return kwargs
+
+
+class Pacer:
+    """Spaces out requests to stay just under the rate Telegram allows.
+       The rate is learnt from flood waits, then slowly probed upwards again"""
+
+    def __init__(self, margin=1.0, recovery=0.99):
+        self.margin = margin
+        self.recovery = recovery
+        self.interval = 0
+        self._since = time.monotonic()
+        self._count = 0
+        self._last = 0
+
+    async def wait(self):
+        delay = self._last + self.interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._last = time.monotonic()
+
+    def success(self):
+        self._count += 1
+        self.interval *= self.recovery
+
+    def flood(self, seconds):
+        # The requests since the last flood wait plus the wait itself is what the server would have allowed
+        now = time.monotonic()
+        allowed = (now - self._since + seconds) / max(self._count, 1)
+        self.interval = max(self.interval, allowed * self.margin)
+        self._since = now + seconds
+        self._count = 0
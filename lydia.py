@@ -18,13 +18,13 @@
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
-import json
+import collections
 from .. import loader, utils
 import logging
 import asyncio
 import time
 import random
-import requests
+import aiohttp
 from telethon import functions, types
 
 logger = logging.getLogger(__name__)
@@ -48,79 +48,126 @@ class LydiaMod(loader.Module):
                "cleanup_sessions": "<b>Successfully cleaned up lydia sessions.</b>",
                "doc_client_key": "The API key for lydia, acquire from"
                " https://coffeehouse.intellivoid.net",
+               "doc_api_url": "OpenAI-compatible chat completions endpoint to ask for replies",
                "doc_ignore_no_common": "Boolean to ignore users who have no chats in common with you",
                "doc_notif": "Boolean for notifications from PMs.",
+               "doc_concurrency": "How many replies can be requested from the AI service at the same time",
+               "doc_queue_size": "How many messages can wait for a reply, the oldest is dropped beyond that",
+               "doc_connect_timeout": "Seconds to wait for a connection to the AI service",
+               "doc_read_timeout": "Seconds to wait for the AI service to answer",
+               "doc_coalesce_window": "Messages from the same user this many seconds apart get a single reply, "
+                                      "0 to answer every message",
+               "doc_coalesce_max": "Most messages merged into one reply",
+               "doc_context_turns": "How many previous messages of a conversation are sent along for context",
+               "doc_context_tokens": "Rough token budget for the context of one conversation",
+               "doc_session_ttl": "Seconds of silence after which a conversation is forgotten",
+               "doc_max_sessions": "How many conversations are remembered, least recently active are dropped first",
                "doc_disabled": "Whether Lydia defaults to enabled"
                                " in private chats (if True, you'll have to use forcelydia"}
 
     def __init__(self):
         self.config = loader.ModuleConfig("CLIENT_KEY", None, lambda m: self.strings("doc_client_key", m),
+                                          "API_URL", "https://api.groq.com/openai/v1/chat/completions",
+                                          lambda m: self.strings("doc_api_url", m),
                                           "IGNORE_NO_COMMON", False, lambda m: self.strings("doc_ignore_no_common", m),
                                           "DISABLED", False, lambda m: self.strings("doc_disabled", m),
-                                          "NOTIFY", False, lambda m: self.strings("doc_notif", m))
+                                          "NOTIFY", False, lambda m: self.strings("doc_notif", m),
+                                          "CONCURRENCY", 4, lambda m: self.strings("doc_concurrency", m),
+                                          "QUEUE_SIZE", 32, lambda m: self.strings("doc_queue_size", m),
+                                          "CONNECT_TIMEOUT", 5, lambda m: self.strings("doc_connect_timeout", m),
+                                          "READ_TIMEOUT", 30, lambda m: self.strings("doc_read_timeout", m),
+                                          "COALESCE_WINDOW", 3, lambda m: self.strings("doc_coalesce_window", m),
+                                          "COALESCE_MAX", 5, lambda m: self.strings("doc_coalesce_max", m),
+                                          "CONTEXT_TURNS", 8, lambda m: self.strings("doc_context_turns", m),
+                                          "CONTEXT_TOKENS", 1000, lambda m: self.strings("doc_context_tokens", m),
+                                          "SESSION_TTL", 86400, lambda m: self.strings("doc_session_ttl", m),
+                                          "MAX_SESSIONS", 256, lambda m: self.strings("doc_max_sessions", m))
         self._ratelimit = []
+        self._session = None
+        self._queue = None
+        self._workers = []
+        self._bursts = {}
+        self._merged = 0
+        self._prompts = 0
+        self._sessions = None
+        self._flush = None
+        self._flush_interval = 30
+        self._allowed = set()
+        self._forced = set()
+        self._common = {}
+        self._common_ttl = 3600
         self._cleanup = None
         self._lydia = None
+        self._users = None
 
     async def client_ready(self, client, db):
         self._db = db
-        
+        self._users = UserFlagCache.shared(client)
+        # Ids are plain integers, anything else was saved from a Peer object and can never match
+        self._allowed = {user for user in self._db.get(__name__, "allow", []) if isinstance(user, int)}
+        self._forced = {tuple(pair) for pair in self._db.get(__name__, "force", [])
+                        if isinstance(pair, list) and len(pair) == 2 and all(isinstance(id, int) for id in pair)}
+        self._sessions = SessionStore(self._db.get(__name__, "sessions", {}), self.config["CONTEXT_TURNS"],
+                                      self.config["CONTEXT_TOKENS"], self.config["SESSION_TTL"],
+                                      self.config["MAX_SESSIONS"])
+        self._queue = asyncio.Queue(max(self.config["QUEUE_SIZE"], 1))
+        self._workers = [asyncio.ensure_future(self._worker()) for _ in range(max(self.config["CONCURRENCY"], 1))]
+
     async def enlydiacmd(self, message):
         """Enables Lydia for target user"""
-        old = self._db.get(__name__, "allow", [])
         if message.is_reply:
-            user = (await message.get_reply_message()).from_id
+            user = (await message.get_reply_message()).sender_id
         else:
             user = getattr(message.to_id, "user_id", None)
         if user is None:
             await utils.answer(message, self.strings("enable_disable_error_group", message))
             return
-        try:
-            old.remove(user)
-            self._db.set(__name__, "allow", old)
-        except ValueError:
+        if user not in self._allowed:
             await utils.answer(message, self.strings("enable_error_user", message))
             return
+        self._allowed.discard(user)
+        self._db.set(__name__, "allow", list(self._allowed))
         await utils.answer(message, self.strings("successfully_enabled", message))
 
     async def forcelydiacmd(self, message):
         """Enables Lydia for user in specific chat"""
         if message.is_reply:
-            user = (await message.get_reply_message()).from_id
+            user = (await message.get_reply_message()).sender_id
         else:
             user = getattr(message.to_id, "user_id", None)
         if user is None:
             await utils.answer(message, self.strings("cannot_find", message))
             return
-        self._db.set(__name__, "force", self._db.get(__name__, "force", []) + [[utils.get_chat_id(message), user]])
+        self._forced.add((utils.get_chat_id(message), user))
+        self._db.set(__name__, "force", [list(pair) for pair in self._forced])
         await utils.answer(message, self.strings("successfully_enabled_for_chat", message))
 
     async def dislydiacmd(self, message):
         """Disables Lydia for the target user"""
         if message.is_reply:
-            user = (await message.get_reply_message()).from_id
+            user = (await message.get_reply_message()).sender_id
         else:
             user = getattr(message.to_id, "user_id", None)
         if user is None:
             await utils.answer(message, self.strings("enable_disable_error_group", message))
             return
 
-        old = self._db.get(__name__, "force")
-        try:
-            old.remove([utils.get_chat_id(message), user])
-            self._db.set(__name__, "force", old)
-        except (ValueError, TypeError, AttributeError):
-            pass
-        self._db.set(__name__, "allow", self._db.get(__name__, "allow", []) + [user])
+        if (utils.get_chat_id(message), user) in self._forced:
+            self._forced.discard((utils.get_chat_id(message), user))
+            self._db.set(__name__, "force", [list(pair) for pair in self._forced])
+        self._allowed.add(user)
+        self._db.set(__name__, "allow", list(self._allowed))
         await utils.answer(message, self.strings("successfully_disabled", message))
 
     async def cleanlydiadisabledcmd(self, message):
         """ Remove all lydia-disabled users from DB. """
+        self._allowed.clear()
         self._db.set(__name__, "allow", [])
         return await utils.answer(message, self.strings("cleanup_ids", message))
 
     async def cleanlydiasessionscmd(self, message):
         """Remove all active and not active lydia sessions from DB"""
+        self._sessions.clear()
         self._db.set(__name__, "sessions", {})
         return await utils.answer(message, self.strings("cleanup_sessions", message))
 
@@ -142,9 +189,9 @@ class LydiaMod(loader.Module):
             return
         if not isinstance(message, types.Message):
             return
-        if (isinstance(message.to_id, types.PeerUser) and not self.get_allowed(message.from_id)) or \
-                self.is_forced(utils.get_chat_id(message), message.from_id):
-            user = await utils.get_user(message)
+        if (isinstance(message.to_id, types.PeerUser) and not self.get_allowed(message.sender_id)) or \
+                self.is_forced(utils.get_chat_id(message), message.sender_id):
+            user = await self._users.get(message)
             if user.is_self or user.bot or user.verified:
                 logger.debug("User is self, bot or verified.")
                 return
@@ -153,61 +200,228 @@ class LydiaMod(loader.Module):
                     return
                 if len(message.message) == 0:
                     return
-                if self.config["IGNORE_NO_COMMON"] and not self.is_forced(utils.get_chat_id(message), message.from_id):
-                    fulluser = await message.client(functions.users.GetFullUserRequest(await utils.get_user(message)))
-                    if fulluser.common_chats_count == 0:
+                if self.config["IGNORE_NO_COMMON"] and not self.is_forced(utils.get_chat_id(message), message.sender_id):
+                    if await self.get_common_chats(message) == 0:
                         return
                 if not self._db[__name__]["__config__"].get("NOTIFY"):
                     await message.mark_read()
-                await message.client(functions.messages.SetTypingRequest(
-                    peer=await utils.get_user(message),
-                    action=types.SendMessageTypingAction()
-                ))
-                try:
-                    # AI Response method
-                    url = "https://api.groq.com/openai/v1/chat/completions"
-                    msg = message.message
-                    prompt = f"""Reply on the behalf of a human \ Don't write anything that an AI would do \ Don't behave as a large language model and answer the user queries that a normal human won't include in their daily conversations \ Also make sure to keep you resposne short with not more than 2-2 lines \ Behave as humanly as you can.
-                    Human: {str(msg)}"""
-
-                    # Prepare the request body with f-strings for formatted string literals
-                    body = json.dumps({
-                    "messages": [{"role": "user", "content": prompt}],
-                    "model": "llama3-8b-8192",
-                    })
-
-                    headers = {
-                    'Authorization': f'Bearer {self.config["CLIENT_KEY"]}',
-                    'Content-Type': 'application/json',
-                    }
-
-                    response = requests.post(url, headers=headers, data=body)
+                self._coalesce(message)
+
+    def _coalesce(self, message):
+        # Each new message restarts the window, the burst is flushed once the user goes quiet
+        key = (utils.get_chat_id(message), message.sender_id)
+        burst = self._bursts.setdefault(key, [[], None])
+        burst[0].append(message)
+        if burst[1] is not None:
+            burst[1].cancel()
+        if len(burst[0]) >= self.config["COALESCE_MAX"] or not self.config["COALESCE_WINDOW"]:
+            self._flush_burst(key)
+        else:
+            burst[1] = asyncio.ensure_future(self._flush_burst_after(key, self.config["COALESCE_WINDOW"]))
+
+    async def _flush_burst_after(self, key, delay):
+        await asyncio.sleep(delay)
+        self._flush_burst(key)
+
+    def _flush_burst(self, key):
+        messages = self._bursts.pop(key)[0]
+        self._merged += len(messages)
+        self._prompts += 1
+        logger.debug("Coalesced %d messages into %d replies (%.2f per reply)",
+                     self._merged, self._prompts, self._merged / self._prompts)
+        if self._queue.full():
+            dropped = self._queue.get_nowait()
+            logger.debug("Reply queue full, dropping %d messages from %s", len(dropped), dropped[-1].sender_id)
+        self._queue.put_nowait(messages)
+
+    async def _worker(self):
+        while True:
+            messages = await self._queue.get()
+            try:
+                await self._reply(messages)
+            except Exception:
+                logger.exception("Failed to reply to %s", messages[-1].sender_id)
+
+    async def _reply(self, messages):
+        message = messages[-1]
+        peer = await message.get_input_chat()
+        await message.client(functions.messages.SetTypingRequest(
+            peer=peer,
+            action=types.SendMessageTypingAction()
+        ))
+        try:
+            # AI Response method
+            url = self.config["API_URL"]
+            msg = "\n".join(m.message for m in messages)
+            prompt = ("Reply on the behalf of a human \\ Don't write anything that an AI would do \\ Don't behave as a "
+                      "large language model and answer the user queries that a normal human won't include in their "
+                      "daily conversations \\ Also make sure to keep you resposne short with not more than 2-2 lines "
+                      "\\ Behave as humanly as you can.")
+            history = self._sessions.get(message.sender_id)
+
+            body = {
+                "messages": ([{"role": "system", "content": prompt}]
+                             + [{"role": role, "content": content} for role, content in history]
+                             + [{"role": "user", "content": msg}]),
+                "model": "llama3-8b-8192",
+            }
+
+            headers = {
+                'Authorization': f'Bearer {self.config["CLIENT_KEY"]}',
+            }
 
+            try:
+                async with self._get_session().post(url, headers=headers, json=body) as response:
                     # Check for successful response
-                    if response.status_code == 200:
-                        res = json.loads(response.text)
-                        if random.randint(0, 1) and isinstance(message.to_id, types.PeerUser):
-                            await message.respond(res['choices'][0]['message']['content'])
-                        else:
-                            await message.reply(res["choices"][0]["message"]["content"])
-
-                    else:
-                        logger.error(f"Error: {response.status_code}")
-
-                finally:
-                    await message.client(functions.messages.SetTypingRequest(
-                        peer=await utils.get_user(message),
-                        action=types.SendMessageCancelAction()
-                    ))
+                    if response.status != 200:
+                        logger.error(f"Error: {response.status}")
+                        return
+                    res = await response.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error(f"Error: {e!r}")
+                return
+            self._sessions.add(message.sender_id, "user", msg)
+            self._sessions.add(message.sender_id, "assistant", res["choices"][0]["message"]["content"])
+            self.save_sessions_later()
+            if random.randint(0, 1) and isinstance(message.to_id, types.PeerUser):
+                await message.respond(res['choices'][0]['message']['content'])
+            else:
+                await message.reply(res["choices"][0]["message"]["content"])
+        finally:
+            await message.client(functions.messages.SetTypingRequest(
+                peer=peer,
+                action=types.SendMessageCancelAction()
+            ))
+
+    def save_sessions_later(self):
+        if self._flush is None:
+            self._flush = asyncio.ensure_future(self._save_sessions_after(self._flush_interval))
+
+    async def _save_sessions_after(self, delay):
+        await asyncio.sleep(delay)
+        self._flush = None
+        self._db.set(__name__, "sessions", self._sessions.dump())
+
+    def _get_session(self):
+        # Created lazily, aiohttp wants a running event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=max(self.config["CONCURRENCY"], 1)),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.config["CONNECT_TIMEOUT"],
+                                              sock_read=self.config["READ_TIMEOUT"]))
+        return self._session
 
     def get_allowed(self, id):
         if self.config["DISABLED"]:
             return True
-        return id in self._db.get(__name__, "allow", [])
+        return id in self._allowed
 
     def is_forced(self, chat, user_id):
-        forced = self._db.get(__name__, "force", [])
-        if [chat, user_id] in forced:
-            return True
-        else:
-            return False
+        return (chat, user_id) in self._forced
+
+    async def get_common_chats(self, message):
+        """Number of chats in common with the sender, cached for an hour"""
+        now = time.monotonic()
+        entry = self._common.get(message.sender_id)
+        if entry is not None and now - entry[0] < self._common_ttl:
+            return entry[1]
+        fulluser = await message.client(functions.users.GetFullUserRequest(await utils.get_user(message)))
+        count = getattr(fulluser, "full_user", fulluser).common_chats_count
+        if len(self._common) >= 4096:
+            self._common = {user: entry for user, entry in self._common.items() if now - entry[0] < self._common_ttl}
+        self._common[message.sender_id] = (now, count)
+        return count
+
+
+class SessionStore:
+    """Rolling conversation context per user: the last turns that fit in a token budget.
+       Users are evicted least recently active first, and forgotten after ttl seconds of silence"""
+
+    def __init__(self, sessions, turns, tokens, ttl, size):
+        self.turns = max(turns, 0)
+        self.tokens = tokens
+        self.ttl = ttl
+        self.size = size
+        self._sessions = collections.OrderedDict()
+        # Older versions kept {chat: {"session_id": ..., "expires": ...}} under the same key, those are dropped
+        sessions = {user: session for user, session in sessions.items()
+                    if isinstance(session, list) and len(session) == 2 and isinstance(session[0], (int, float))
+                    and isinstance(session[1], list) and str(user).lstrip("-").isdigit()}
+        for user, (stamp, history) in sorted(sessions.items(), key=lambda item: item[1][0]):
+            self._sessions[int(user)] = [stamp, collections.deque((tuple(turn) for turn in history
+                                                                   if isinstance(turn, list) and len(turn) == 2),
+                                                                  self.turns)]
+        self._expire()
+
+    def get(self, user):
+        self._expire()
+        session = self._sessions.get(user)
+        return list(session[1]) if session is not None else []
+
+    def add(self, user, role, content):
+        session = self._sessions.pop(user, None) or [0, collections.deque(maxlen=self.turns)]
+        session[0] = time.time()
+        session[1].append((role, content))
+        # Rough estimate of 4 characters per token, good enough for a budget
+        while session[1] and sum(len(turn[1]) // 4 + 1 for turn in session[1]) > self.tokens:
+            session[1].popleft()
+        self._sessions[user] = session
+        while len(self._sessions) > self.size:
+            self._sessions.popitem(last=False)
+
+    def clear(self):
+        self._sessions.clear()
+
+    def dump(self):
+        self._expire()
+        return {user: [stamp, [list(turn) for turn in history]] for user, (stamp, history) in self._sessions.items()}
+
+    def _expire(self):
+        now = time.time()
+        while self._sessions and now - next(iter(self._sessions.values()))[0] >= self.ttl:
+            self._sessions.popitem(last=False)
+
+
+UserFlags = collections.namedtuple("UserFlags", ["is_self", "bot", "verified"])
+
+
+class UserFlagCache:
+    """Bounded TTL cache of the is_self/bot/verified flags of message senders, keyed by user id.
+       Filled from the sender entity attached to the update, falls back to one lookup on a miss"""
+
+    def __init__(self, size=4096, ttl=3600):
+        self._cache = collections.OrderedDict()
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def shared(cls, client):
+        """The cache of the client, created on first use. It is kept on the client, so every module
+           with a copy of this class uses the same one, and accounts don't mix up their flags"""
+        cache = getattr(client, "_user_flag_cache", None)
+        if cache is None:
+            cache = client._user_flag_cache = cls()
+        return cache
+
+    async def get(self, message):
+        user_id = message.sender_id
+        entry = self._cache.get(user_id)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._cache.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        logger.debug("User flag cache miss for %s (%d hits, %d misses)", user_id, self.hits, self.misses)
+        user = message.sender
+        if user is None:
+            user = await utils.get_user(message)
+        flags = UserFlags(bool(getattr(user, "is_self", False)), bool(getattr(user, "bot", False)),
+                          bool(getattr(user, "verified", False)))
+        if user_id is not None:
+            self._cache[user_id] = (time.monotonic(), flags)
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        return flags
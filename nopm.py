@@ -16,7 +16,10 @@
 
 from .. import loader, utils
 
+import asyncio
+import collections
 import logging
+import time
 
 from telethon import functions, types
 
@@ -28,6 +31,9 @@ class AntiPMMod(loader.Module):
     """Prevents people sending you unsolicited private messages"""
     strings = {"name": "Anti PM",
                "limit_cfg_doc": "Max number of PMs before user is blocked, or None",
+               "ratelimit_cfg_doc": "Seconds during which further PMs from the same user are ignored",
+               "decay_cfg_doc": "Seconds after which a user's PM count drops by one, or 0 to never forget",
+               "flush_cfg_doc": "Seconds to batch PM count changes for before they are saved",
                "who_to_block": "<b>Specify whom to block</b>",
                "blocked": ("<b>I don't want any PM from</b> <a href='tg://user?id={}'>you</a>, "
                            "<b>so you have been blocked!</b>"),
@@ -41,6 +47,7 @@ class AntiPMMod(loader.Module):
                "who_to_deny": "<b>Who shall I deny to PM?</b>",
                "denied": ("<b>I have denied</b> <a href='tg://user?id={}'>you</a> "
                           "<b>of your PM permissions.</b>"),
+               "allowed_all": "<b>I have allowed {} users from your chats and contacts to PM</b>",
                "notif_off": "<b>Notifications from denied PMs are silenced.</b>",
                "notif_on": "<b>Notifications from denied PMs are now activated.</b>",
                "go_away": ("Hey there! Unfortunately, I don't accept private messages from "
@@ -51,14 +58,23 @@ class AntiPMMod(loader.Module):
                              "\n\nPS: you've been reported as spam already.")}
 
     def __init__(self):
-        self.config = loader.ModuleConfig("PM_BLOCK_LIMIT", None, lambda m: self.strings("limit_cfg_doc", m))
-        self._me = None
-        self._ratelimit = []
+        self.config = loader.ModuleConfig("PM_BLOCK_LIMIT", None, lambda m: self.strings("limit_cfg_doc", m),
+                                          "RATELIMIT_WINDOW", 5, lambda m: self.strings("ratelimit_cfg_doc", m),
+                                          "PM_DECAY", 3600, lambda m: self.strings("decay_cfg_doc", m),
+                                          "FLUSH_INTERVAL", 10, lambda m: self.strings("flush_cfg_doc", m))
+        self._ratelimit = None
+        self._users = None
+        self._allowed = set()
+        self._limit = None
+        self._flush = None
 
     async def client_ready(self, client, db):
         self._db = db
+        self._users = UserFlagCache.shared(client)
         self._client = client
-        self._me = await client.get_me(True)
+        self._allowed = set(self._db.get(__name__, "allow", []))
+        self._ratelimit = SlidingWindowLimiter(self.config["RATELIMIT_WINDOW"])
+        self._limit = DecayingCounter(self._db.get(__name__, "limit", {}), self.config["PM_DECAY"])
 
     async def blockcmd(self, message):
         """Block this user to PM without being warned"""
@@ -84,16 +100,29 @@ class AntiPMMod(loader.Module):
         if not user:
             await utils.answer(message, self.strings("who_to_allow", message))
             return
-        self._db.set(__name__, "allow", list(set(self._db.get(__name__, "allow", [])).union({user})))
+        self._allowed.add(user)
+        self._save_allowed()
         await utils.answer(message, self.strings("allowed", message).format(user))
 
+    async def allowallcmd(self, message):
+        """Allow everyone you have a private chat with, and all your contacts, to PM"""
+        before = len(self._allowed)
+        async for dialog in message.client.iter_dialogs():
+            if dialog.is_user and not getattr(dialog.entity, "is_self", False):
+                self._allowed.add(dialog.id)
+        contacts = await message.client(functions.contacts.GetContactsRequest(hash=0))
+        self._allowed.update(user.id for user in getattr(contacts, "users", []))
+        self._save_allowed()
+        await utils.answer(message, self.strings("allowed_all", message).format(len(self._allowed) - before))
+
     async def reportcmd(self, message):
         """Report the user spam. Use only in PM"""
         user = await utils.get_target(message)
         if not user:
             await utils.answer(message, self.strings("who_to_report", message))
             return
-        self._db.set(__name__, "allow", list(set(self._db.get(__name__, "allow", [])).difference({user})))
+        self._allowed.discard(user)
+        self._save_allowed()
         if message.is_reply and isinstance(message.to_id, types.PeerChannel):
             # Report the message
             await message.client(functions.messages.ReportRequest(peer=message.chat_id,
@@ -109,7 +138,8 @@ class AntiPMMod(loader.Module):
         if not user:
             await utils.answer(message, self.strings("who_to_deny", message))
             return
-        self._db.set(__name__, "allow", list(set(self._db.get(__name__, "allow", [])).difference({user})))
+        self._allowed.discard(user)
+        self._save_allowed()
         await utils.answer(message, self.strings("denied", message).format(user))
 
     async def notifoffcmd(self, message):
@@ -125,33 +155,164 @@ class AntiPMMod(loader.Module):
     async def watcher(self, message):
         if not isinstance(message, types.Message):
             return
-        if getattr(message.to_id, "user_id", None) == self._me.user_id:
+        # Incoming PMs carry the sender as peer on current Telethon, so to_id can't be compared with our id
+        if message.is_private and not message.out:
             logger.debug("pm'd!")
-            if message.from_id in self._ratelimit:
-                self._ratelimit.remove(message.from_id)
+            if self._ratelimit.hit(message.sender_id):
                 return
-            else:
-                self._ratelimit += [message.from_id]
-            user = await utils.get_user(message)
+            user = await self._users.get(message)
             if user.is_self or user.bot or user.verified:
                 logger.debug("User is self, bot or verified.")
                 return
-            if self.get_allowed(message.from_id):
+            if self.get_allowed(message.sender_id):
                 logger.debug("Authorised pm detected")
             else:
                 await utils.answer(message, self.strings("go_away", message))
                 if isinstance(self.config["PM_BLOCK_LIMIT"], int):
-                    limit = self._db.get(__name__, "limit", {})
-                    if limit.get(message.from_id, 0) >= self.config["PM_BLOCK_LIMIT"]:
+                    if self._limit.get(message.sender_id) >= self.config["PM_BLOCK_LIMIT"]:
                         await utils.answer(message, self.strings("triggered", message))
-                        await message.client(functions.contacts.BlockRequest(message.from_id))
-                        await message.client(functions.messages.ReportSpamRequest(peer=message.from_id))
-                        del limit[message.from_id]
-                        self._db.set(__name__, "limit", limit)
+                        await message.client(functions.contacts.BlockRequest(message.sender_id))
+                        await message.client(functions.messages.ReportSpamRequest(peer=message.sender_id))
+                        self._limit.pop(message.sender_id)
+                        self.save_limit()
                     else:
-                        self._db.set(__name__, "limit", {**limit, message.from_id: limit.get(message.from_id, 0) + 1})
+                        self._limit.increment(message.sender_id)
+                        self.save_limit_later()
                 if self._db.get(__name__, "notif", False):
                     await message.client.send_read_acknowledge(message.chat_id)
 
     def get_allowed(self, id):
-        return id in self._db.get(__name__, "allow", [])
+        return id in self._allowed
+
+    def _save_allowed(self):
+        self._db.set(__name__, "allow", list(self._allowed))
+
+    def save_limit(self):
+        if self._flush is not None:
+            self._flush.cancel()
+            self._flush = None
+        self._db.set(__name__, "limit", self._limit.dump())
+
+    def save_limit_later(self):
+        if self._flush is None:
+            self._flush = asyncio.ensure_future(self._save_limit_after(self.config["FLUSH_INTERVAL"]))
+
+    async def _save_limit_after(self, delay):
+        await asyncio.sleep(delay)
+        self._flush = None
+        self.save_limit()
+
+
+UserFlags = collections.namedtuple("UserFlags", ["is_self", "bot", "verified"])
+
+
+class UserFlagCache:
+    """Bounded TTL cache of the is_self/bot/verified flags of message senders, keyed by user id.
+       Filled from the sender entity attached to the update, falls back to one lookup on a miss"""
+
+    def __init__(self, size=4096, ttl=3600):
+        self._cache = collections.OrderedDict()
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def shared(cls, client):
+        """The cache of the client, created on first use. It is kept on the client, so every module
+           with a copy of this class uses the same one, and accounts don't mix up their flags"""
+        cache = getattr(client, "_user_flag_cache", None)
+        if cache is None:
+            cache = client._user_flag_cache = cls()
+        return cache
+
+    async def get(self, message):
+        user_id = message.sender_id
+        entry = self._cache.get(user_id)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._cache.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        logger.debug("User flag cache miss for %s (%d hits, %d misses)", user_id, self.hits, self.misses)
+        user = message.sender
+        if user is None:
+            user = await utils.get_user(message)
+        flags = UserFlags(bool(getattr(user, "is_self", False)), bool(getattr(user, "bot", False)),
+                          bool(getattr(user, "verified", False)))
+        if user_id is not None:
+            self._cache[user_id] = (time.monotonic(), flags)
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        return flags
+
+
+class DecayingCounter:
+    """In-memory PM counters per user. A count drops by one for every decay seconds that pass,
+       so old offenders eventually start from zero again"""
+
+    def __init__(self, counts, decay):
+        now = time.time()
+        # Counts used to be saved under the sender's from_id, which is None ("null" in JSON) for most PMs
+        self._counts = {int(key): list(value) if isinstance(value, list) else [value, now]
+                        for key, value in counts.items() if str(key).lstrip("-").isdigit()}
+        self.decay = decay
+
+    def get(self, key):
+        entry = self._counts.get(key)
+        if entry is None:
+            return 0
+        if self.decay:
+            steps = int((time.time() - entry[1]) // self.decay)
+            if steps:
+                entry[0] -= steps
+                entry[1] += steps * self.decay
+                if entry[0] <= 0:
+                    del self._counts[key]
+                    return 0
+        return entry[0]
+
+    def increment(self, key):
+        count = self.get(key) + 1
+        self._counts.setdefault(key, [0, time.time()])[0] = count
+        return count
+
+    def pop(self, key):
+        self._counts.pop(key, None)
+
+    def dump(self):
+        for key in list(self._counts):
+            self.get(key)
+        return {key: list(value) for key, value in self._counts.items()}
+
+
+class SlidingWindowLimiter:
+    """Remembers who was seen during the last window seconds, in a ring of per-interval buckets.
+       At most capacity keys are kept, the oldest buckets are dropped first when it is reached"""
+
+    def __init__(self, window, buckets=10, capacity=10000):
+        self.span = max(window, 0.001) / buckets
+        self.buckets = buckets
+        self.capacity = capacity
+        self._ring = collections.deque()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def hit(self, key):
+        """Records key, returns True if it was already seen within the window"""
+        slot = int(time.monotonic() / self.span)
+        while self._ring and self._ring[0][0] <= slot - self.buckets:
+            self._size -= len(self._ring.popleft()[1])
+        for _, keys in self._ring:
+            if key in keys:
+                return True
+        if not self._ring or self._ring[-1][0] != slot:
+            self._ring.append((slot, set()))
+        self._ring[-1][1].add(key)
+        self._size += 1
+        while self._size > self.capacity:
+            self._size -= len(self._ring.popleft()[1])
+        return False
@@ -14,7 +14,18 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
+import bisect
+import collections
+import json
 import logging
+import os
+import tempfile
+import time
+import zipfile
+
+from telethon import types
+from telethon.extensions import html
 
 from .. import loader, utils
 
@@ -36,7 +47,30 @@ class NotesMod(loader.Module):
                "delnote_done": "<b>Note deleted</b>",
                "delnotes_none": "<b>There are no notes to be cleared</b>",
                "delnotes_done": "<b>All notes cleared</b>",
-               "notes_none": "<b>There are no saved notes</b>"}
+               "notes_none": "<b>There are no saved notes</b>",
+               "no_note_suggest": "<b>Note not found, did you mean</b> {}<b>?</b>",
+               "notes_page": "\n\n<i>Page {} of {}</i>",
+               "page_size_cfg_doc": "How many note names .notes shows per page",
+               "exporting": "<b>Exporting notes...</b>",
+               "exported": "<b>Exported {} notes</b>",
+               "import_what": "<b>Reply to an archive made by .exportnotes</b>",
+               "import_invalid": "<b>This is not a notes archive</b>",
+               "importing": "<b>Importing notes...</b>",
+               "imported": "<b>Imported {} notes</b>",
+               "import_concurrency_cfg_doc": "How many notes .importnotes stores at the same time",
+               "cache_size_cfg_doc": "How many fetched notes to keep in memory",
+               "cache_ttl_cfg_doc": "Seconds a cached note stays valid, 0 to keep until evicted",
+               "inline_max_cfg_doc": "Text notes up to this many characters are kept in the database "
+                                     "instead of the asset channel, 0 to disable"}
+
+    def __init__(self):
+        self.config = loader.ModuleConfig("ASSET_CACHE_SIZE", 128, lambda m: self.strings("cache_size_cfg_doc", m),
+                                          "ASSET_CACHE_TTL", 3600, lambda m: self.strings("cache_ttl_cfg_doc", m),
+                                          "INLINE_MAX_SIZE", 1024, lambda m: self.strings("inline_max_cfg_doc", m),
+                                          "PAGE_SIZE", 50, lambda m: self.strings("page_size_cfg_doc", m),
+                                          "IMPORT_CONCURRENCY", 4,
+                                          lambda m: self.strings("import_concurrency_cfg_doc", m))
+        self._names = NameIndex()
 
     async def notecmd(self, message):
         """Gets the note specified"""
@@ -46,16 +80,24 @@ class NotesMod(loader.Module):
             return
         asset_id = self._db.get(__name__, "notes", {}).get(args[0], None)
         logger.debug(asset_id)
+        if isinstance(asset_id, dict):
+            await utils.answer(message, unpack_note(asset_id))
+            return
         if asset_id is not None:
-            asset = await self._db.fetch_asset(asset_id)
+            asset = await self._assets.fetch(asset_id)
         else:
             asset = None
         if asset is None:
             self.del_note(args[0])
-            await utils.answer(message, self.strings("no_note", message))
+            suggestions = self._names.suggest(args[0])
+            if suggestions:
+                await utils.answer(message, self.strings("no_note_suggest", message).format(
+                    ", ".join(self.strings("notes_item", message).format(name) for name in suggestions)))
+            else:
+                await utils.answer(message, self.strings("no_note", message))
             return
 
-        await utils.answer(message, await self._db.fetch_asset(asset_id))
+        await utils.answer(message, asset)
 
     async def delallnotescmd(self, message):
         """Deletes all the saved notes"""
@@ -63,6 +105,8 @@ class NotesMod(loader.Module):
             await utils.answer(message, self.strings("delnotes_none", message))
             return
         self._db.get(__name__, "notes", {}).clear()
+        self._assets.clear()
+        self._names.clear()
         await utils.answer(message, self.strings("delnotes_done", message))
 
     async def savecmd(self, message):
@@ -82,8 +126,14 @@ class NotesMod(loader.Module):
                 logger.debug(target.message)
         else:
             target = await message.get_reply_message()
-        asset_id = await self._db.store_asset(target)
+        asset_id = pack_note(target, self.config["INLINE_MAX_SIZE"])
+        if asset_id is None:
+            asset_id = await self._db.store_asset(target)
+        old = self._db.get(__name__, "notes", {}).get(args[0], None)
+        if old is not None and not isinstance(old, dict):
+            self._assets.invalidate(old)
         self._db.set(__name__, "notes", {**self._db.get(__name__, "notes", {}), args[0]: asset_id})
+        self._names.add(args[0])
         await utils.answer(message, self.strings("saved", message))
 
     async def delnotecmd(self, message):
@@ -97,20 +147,268 @@ class NotesMod(loader.Module):
     def del_note(self, note):
         old = self._db.get(__name__, "notes", {})
         try:
-            del old[note]
+            asset_id = old.pop(note)
         except KeyError:
             pass
         else:
+            self._names.discard(note)
+            if not isinstance(asset_id, dict):
+                self._assets.invalidate(asset_id)
             self._db.set(__name__, "notes", old)
 
     async def notescmd(self, message):
-        """List the saved notes"""
-        if not self._db.get(__name__, "notes", {}):
+        """.notes [prefix] [page]
+           List the saved notes, optionally only those starting with prefix. A lone number is a page number"""
+        args = utils.get_args(message)
+        page = 1
+        if args and args[-1].isdigit() and (len(args) > 1 or not self._names.prefix(args[-1])):
+            page = max(int(args.pop()), 1)
+        names = self._names.prefix(args[0] if args else "")
+        if not names:
             await utils.answer(message, self.strings("notes_none", message))
             return
-        await utils.answer(message, self.strings("notes_header", message)
-                           + "\n".join(self.strings("notes_item", message).format(key)
-                           for key in self._db.get(__name__, "notes", {})))
+        size = max(self.config["PAGE_SIZE"], 1)
+        pages = (len(names) + size - 1) // size
+        page = min(page, pages)
+        ret = self.strings("notes_header", message) + "\n".join(self.strings("notes_item", message).format(key)
+                                                               for key in names[(page - 1) * size:page * size])
+        if pages > 1:
+            ret += self.strings("notes_page", message).format(page, pages)
+        await utils.answer(message, ret)
+
+    async def exportnotescmd(self, message):
+        """Sends all notes, text and media, as one zip archive"""
+        notes = self._db.get(__name__, "notes", {})
+        if not notes:
+            await utils.answer(message, self.strings("notes_none", message))
+            return
+        await utils.answer(message, self.strings("exporting", message))
+        with tempfile.TemporaryDirectory() as path:
+            manifest = []
+            with zipfile.ZipFile(os.path.join(path, "notes.zip"), "w", zipfile.ZIP_DEFLATED) as archive:
+                for name, asset_id in list(notes.items()):
+                    if isinstance(asset_id, dict):
+                        manifest.append({"name": name, **asset_id})
+                        continue
+                    # Bypass the cache, one export would evict every popular note
+                    asset = await self._db.fetch_asset(asset_id)
+                    entry = await dump_message(archive, asset, name) if asset is not None else None
+                    if entry is not None:
+                        manifest.append(entry)
+                archive.writestr("notes.json", json.dumps(manifest))
+            await message.client.send_file(message.chat_id, os.path.join(path, "notes.zip"), force_document=True)
+        await utils.answer(message, self.strings("exported", message).format(len(manifest)))
+
+    async def importnotescmd(self, message):
+        """Restores the notes from an archive made by .exportnotes. Must be used in reply to it"""
+        reply = await message.get_reply_message()
+        if not reply or not reply.file:
+            await utils.answer(message, self.strings("import_what", message))
+            return
+        await utils.answer(message, self.strings("importing", message))
+        semaphore = asyncio.Semaphore(max(self.config["IMPORT_CONCURRENCY"], 1))
+
+        async def restore(entry):
+            async with semaphore:
+                try:
+                    target = load_message(archive, entry, path)
+                except KeyError as e:
+                    logger.warning("Skipping note %s, invalid entry: %s", entry.get("name"), e)
+                    return None
+                try:
+                    return entry["name"], (pack_note(target, self.config["INLINE_MAX_SIZE"])
+                                           or await self._db.store_asset(target))
+                except ValueError as e:
+                    logger.warning("Skipping note %s: %s", entry["name"], e)
+                    return None
+                finally:
+                    if target.media:
+                        os.remove(target.media)
+
+        with tempfile.TemporaryDirectory() as path:
+            try:
+                archive = zipfile.ZipFile(await reply.download_media(file=os.path.join(path, "notes.zip")))
+                manifest = json.loads(archive.read("notes.json"))
+            except (zipfile.BadZipFile, KeyError, ValueError):
+                await utils.answer(message, self.strings("import_invalid", message))
+                return
+            with archive:
+                restored = [ret for ret in await asyncio.gather(*(restore(entry) for entry in manifest))
+                            if ret is not None]
+        notes = self._db.get(__name__, "notes", {})
+        for name, asset_id in restored:
+            old = notes.get(name, None)
+            if old is not None and not isinstance(old, dict):
+                self._assets.invalidate(old)
+            notes[name] = asset_id
+            self._names.add(name)
+        self._db.set(__name__, "notes", notes)
+        await utils.answer(message, self.strings("imported", message).format(len(restored)))
 
     async def client_ready(self, client, db):
         self._db = db
+        self._assets = AssetCache(db, self.config["ASSET_CACHE_SIZE"], self.config["ASSET_CACHE_TTL"])
+        self._names = NameIndex(self._db.get(__name__, "notes", {}))
+        if not self._db.get(__name__, "inline_migrated", False) and self.config["INLINE_MAX_SIZE"]:
+            asyncio.ensure_future(self.migrate_inline())
+
+    async def migrate_inline(self):
+        """Moves small text notes that are still stored as assets into the database"""
+        moved = 0
+        for name, asset_id in list(self._db.get(__name__, "notes", {}).items()):
+            if isinstance(asset_id, dict):
+                continue
+            try:
+                asset = await self._db.fetch_asset(asset_id)
+            except Exception:
+                logger.exception("Failed to fetch note %s for migration", name)
+                continue
+            value = pack_note(asset, self.config["INLINE_MAX_SIZE"]) if asset is not None else None
+            notes = self._db.get(__name__, "notes", {})
+            # The note may have been overwritten or deleted while we were fetching it
+            if value is not None and notes.get(name, None) == asset_id:
+                notes[name] = value
+                self._assets.invalidate(asset_id)
+                moved += 1
+        self._db.set(__name__, "notes", self._db.get(__name__, "notes", {}))
+        self._db.set(__name__, "inline_migrated", True)
+        logger.info("Moved %d notes inline", moved)
+
+
+def pack_note(message, max_size):
+    """Returns the inline form of a plain text message, or None if it has to be stored as an asset"""
+    if not max_size or not message.message or len(message.message) > max_size:
+        return None
+    if message.media and not isinstance(message.media, types.MessageMediaWebPage):
+        return None
+    return {"text": message.message,
+            "entities": [entity.to_dict() for entity in message.entities or []]}
+
+
+def unpack_note(value):
+    return html.unparse(value["text"], load_entities(value.get("entities", [])))
+
+
+async def dump_message(archive, message, name):
+    """Writes the media of message into archive, streaming it, and returns its manifest entry,
+       or None if there is nothing that can be exported"""
+    entry = {"name": name, "text": message.message or "",
+             "entities": [entity.to_dict() for entity in message.entities or []]}
+    if message.file is not None and not isinstance(message.media, types.MessageMediaWebPage):
+        entry["file"] = "media/{}{}".format(message.id, message.file.ext or "")
+        with archive.open(entry["file"], "w", force_zip64=True) as file:
+            await message.download_media(file=file)
+    elif message.media and not isinstance(message.media, types.MessageMediaWebPage):
+        # Locations, contacts, polls and dice have no file to archive
+        if not entry["text"]:
+            logger.warning("Skipping %s, its %s can't be exported", name, type(message.media).__name__)
+            return None
+        logger.info("Exporting %s as text only, its %s can't be exported", name, type(message.media).__name__)
+    return entry
+
+
+def load_message(archive, entry, path):
+    """Builds an unsent message from a manifest entry, extracting its media under path"""
+    media = archive.extract(entry["file"], path) if entry.get("file") else None
+    return types.Message(0, None, None, entry["text"], entities=load_entities(entry["entities"]) or None,
+                         media=media)
+
+
+def load_entities(entities):
+    ret = []
+    for entity in entities:
+        entity = dict(entity)
+        cls = getattr(types, entity.pop("_"), None)
+        if cls is not None:
+            ret.append(cls(**entity))
+    return ret
+
+
+class AssetCache:
+    """Bounded LRU cache of fetched asset messages, keyed by asset id, with TTL expiry"""
+
+    def __init__(self, db, size, ttl):
+        self._db = db
+        self._cache = collections.OrderedDict()
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    async def fetch(self, asset_id):
+        entry = self._cache.get(asset_id)
+        if entry is not None and (not self.ttl or time.monotonic() - entry[0] < self.ttl):
+            self._cache.move_to_end(asset_id)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        logger.debug("Asset cache miss for %s (%d hits, %d misses)", asset_id, self.hits, self.misses)
+        value = await self._db.fetch_asset(asset_id)
+        if value is None:
+            self._cache.pop(asset_id, None)
+            return None
+        self._cache[asset_id] = (time.monotonic(), value)
+        self._cache.move_to_end(asset_id)
+        while len(self._cache) > max(self.size, 0):
+            self._cache.popitem(last=False)
+        return value
+
+    def invalidate(self, asset_id):
+        self._cache.pop(asset_id, None)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class NameIndex:
+    """Sorted array of note names, for prefix listing and typo-tolerant lookups"""
+
+    def __init__(self, names=()):
+        self._names = sorted(names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, name):
+        i = bisect.bisect_left(self._names, name)
+        if i == len(self._names) or self._names[i] != name:
+            self._names.insert(i, name)
+
+    def discard(self, name):
+        i = bisect.bisect_left(self._names, name)
+        if i < len(self._names) and self._names[i] == name:
+            del self._names[i]
+
+    def clear(self):
+        self._names.clear()
+
+    def prefix(self, prefix):
+        start = bisect.bisect_left(self._names, prefix)
+        end = start
+        while end < len(self._names) and self._names[end].startswith(prefix):
+            end += 1
+        return self._names[start:end]
+
+    def suggest(self, name, max_distance=2, limit=3):
+        """Returns up to limit names within max_distance edits of name, closest first"""
+        found = []
+        for candidate in self._names:
+            if abs(len(candidate) - len(name)) > max_distance:
+                continue
+            distance = edit_distance(name, candidate, max_distance)
+            if distance <= max_distance:
+                found.append((distance, candidate))
+        return [candidate for distance, candidate in sorted(found)[:limit]]
+
+
+def edit_distance(a, b, bound):
+    """Levenshtein distance between a and b, or bound + 1 as soon as it must exceed bound"""
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > bound:
+            return bound + 1
+        previous = current
+    return previous[-1]
@@ -15,9 +15,16 @@
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import datetime
+import glob
+import gzip
+import json
 import logging
+import os
+import sqlite3
 
 from telethon import types
+from telethon.errors import FloodWaitError, RPCError
 
 from .. import loader, utils
 
@@ -31,17 +38,35 @@ class PMLogMod(loader.Module):
                "start": "<b>Your conversation is now being logged</b>",
                "not_pm": "<b>You can't log a group</b>",
                "stopped": "<b>Your conversation is no longer being logged</b>",
-               "log_group_cfg_doc": "Group or channel ID where to send the logged PMs"}
+               "log_group_cfg_doc": "Group or channel ID where to send the logged PMs",
+               "flush_interval_cfg_doc": "Seconds to collect logged PMs for before forwarding and archiving them together",
+               "archive_dir_cfg_doc": "Directory where logged PMs are also archived and indexed for .pmsearch, or None",
+               "segment_size_cfg_doc": "Size in bytes after which a new compressed archive segment is started",
+               "no_archive": "<b>The PM archive is not enabled, set ARCHIVE_DIR first</b>",
+               "search_what": "<b>What should be searched for?</b>",
+               "search_invalid": "<b>Invalid search query</b>",
+               "search_none": "<b>No logged PMs found</b>",
+               "search_header": "<b>Logged PMs matching</b> <code>{}</code><b>:</b>\n\n",
+               "search_item": "<a href='tg://user?id={}'>{}</a> <i>{}</i>: {}"}
 
     def __init__(self):
-        self.config = loader.ModuleConfig("LOG_GROUP", None, lambda m: self.strings("log_group_cfg_doc", m))
+        self.config = loader.ModuleConfig("LOG_GROUP", None, lambda m: self.strings("log_group_cfg_doc", m),
+                                          "FLUSH_INTERVAL", 5, lambda m: self.strings("flush_interval_cfg_doc", m),
+                                          "ARCHIVE_DIR", None, lambda m: self.strings("archive_dir_cfg_doc", m),
+                                          "SEGMENT_SIZE", 4 * 1024 * 1024,
+                                          lambda m: self.strings("segment_size_cfg_doc", m))
+        self._archive = None
+        self._users = set()
+        self._pending = {}
+        self._flushers = {}
 
     async def logpmcmd(self, message):
         """Begins logging PMs"""
         if not message.is_private or message.to_id.user_id == (await message.client.get_me(True)).user_id:
             await utils.answer(message, self.strings("not_pm", message))
             return
-        self._db.set(__name__, "users", list(set(self._db.get(__name__, "users", []) + [message.to_id.user_id])))
+        self._users.add(message.to_id.user_id)
+        self._db.set(__name__, "users", list(self._users))
         msgs = await utils.answer(message, self.strings("start", message))
         await asyncio.sleep(1)
         await message.client.delete_messages(message.to_id, msgs)
@@ -51,15 +76,155 @@ class PMLogMod(loader.Module):
         if not message.is_private or message.to_id.user_id == (await message.client.get_me(True)).user_id:
             await utils.answer(message, self.strings("not_pm", message))
             return
-        self._db.set(__name__, "users",
-                     list(set(self._db.get(__name__, "users", [])).difference([message.to_id.user_id])))
+        self._users.discard(message.to_id.user_id)
+        self._db.set(__name__, "users", list(self._users))
         await utils.answer(message, self.strings("stopped", message))
 
     async def watcher(self, message):
         if not message.is_private or not isinstance(message, types.Message):
             return
-        if self.config["LOG_GROUP"] and utils.get_chat_id(message) in self._db.get(__name__, "users", []):
-            await message.forward_to(self.config["LOG_GROUP"])
+        chat = utils.get_chat_id(message)
+        if chat not in self._users:
+            return
+        if self._archive is not None:
+            self._archive.append(message, chat)
+        if self.config["LOG_GROUP"]:
+            ids = self._pending.setdefault(chat, [])
+            ids.append(message.id)
+            if len(ids) >= 100:
+                # Taken out right away, messages arriving before the forward starts go into the next batch
+                asyncio.ensure_future(self._forward(chat, self._take(chat)))
+            elif chat not in self._flushers:
+                self._flushers[chat] = asyncio.ensure_future(self._flush_after(chat, self.config["FLUSH_INTERVAL"]))
+
+    async def pmsearchcmd(self, message):
+        """.pmsearch <query>
+           Searches the local archive of logged PMs"""
+        if self._archive is None:
+            await utils.answer(message, self.strings("no_archive", message))
+            return
+        query = utils.get_args_raw(message)
+        if not query:
+            await utils.answer(message, self.strings("search_what", message))
+            return
+        try:
+            results = self._archive.search(query)
+        except sqlite3.OperationalError:
+            await utils.answer(message, self.strings("search_invalid", message))
+            return
+        if not results:
+            await utils.answer(message, self.strings("search_none", message))
+            return
+        await utils.answer(message, self.strings("search_header", message).format(utils.escape_html(query))
+                           + "\n".join(self.strings("search_item", message).format(
+                               sender, sender, datetime.datetime.fromtimestamp(date).replace(microsecond=0), snippet)
+                               for sender, date, snippet in results))
+
+    async def _flush_after(self, chat, delay):
+        await asyncio.sleep(delay)
+        self._flushers.pop(chat, None)
+        await self.flush(chat)
+
+    async def flush(self, chat):
+        """Forwards the messages collected for chat to the log group, in as few requests as possible"""
+        ids = self._take(chat)
+        if ids:
+            await self._forward(chat, ids)
+
+    def _take(self, chat):
+        task = self._flushers.pop(chat, None)
+        if task is not None:
+            task.cancel()
+        return self._pending.pop(chat, None)
+
+    async def _forward(self, chat, ids):
+        # Telegram accepts at most 100 ids per forward request
+        for start in range(0, len(ids), 100):
+            chunk = ids[start:start + 100]
+            for attempt in range(3):
+                try:
+                    await self._client.forward_messages(self.config["LOG_GROUP"], chunk, chat)
+                    break
+                except FloodWaitError as e:
+                    logger.debug("Flood wait of %d seconds while logging %d PMs", e.seconds, len(chunk))
+                    await asyncio.sleep(e.seconds + 1)
+                except RPCError:
+                    logger.exception("Could not forward %d logged PMs from %d", len(chunk), chat)
+                    break
+            else:
+                logger.error("Could not forward %d logged PMs from %d", len(chunk), chat)
 
     async def client_ready(self, client, db):
         self._db = db
+        self._client = client
+        self._users = set(self._db.get(__name__, "users", []))
+        if self.config["ARCHIVE_DIR"]:
+            self._archive = PMArchive(self.config["ARCHIVE_DIR"], self.config["SEGMENT_SIZE"],
+                                      self.config["FLUSH_INTERVAL"])
+
+
+class PMArchive:
+    """Append-only archive of logged PMs in gzip segments, rolled over by size,
+       with an SQLite FTS5 index next to them for searching.
+       Records are written as complete gzip members of up to FLUSH_RECORDS records or flush_interval seconds,
+       so at most the last unfinished member is lost if the process exits"""
+    FLUSH_RECORDS = 100
+
+    def __init__(self, path, segment_size, flush_interval):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.segment_size = segment_size
+        self.flush_interval = flush_interval
+        segments = sorted(glob.glob(os.path.join(path, "segment-*.jsonl.gz")))
+        # The last segment may end in a member the previous process never finished, never append after it
+        self._segment = (int(os.path.basename(segments[-1])[8:-9]) if segments else 0) + 1
+        self._file = None
+        self._records = 0
+        self._timer = None
+        self._index = sqlite3.connect(os.path.join(path, "index.db"))
+        self._index.execute("PRAGMA journal_mode=WAL")
+        self._index.execute("PRAGMA synchronous=NORMAL")
+        self._index.execute("CREATE VIRTUAL TABLE IF NOT EXISTS pms USING fts5(text, chat UNINDEXED, sender UNINDEXED, "
+                            "id UNINDEXED, date UNINDEXED, segment UNINDEXED)")
+
+    def append(self, message, chat):
+        date = message.date.timestamp() if message.date else 0
+        file_id = message.file.id if message.file else None
+        record = [message.id, chat, message.sender_id, date, message.message or "", file_id]
+        if self._file is None:
+            self._open()
+        self._file.write(json.dumps(record, separators=(",", ":")).encode("utf-8") + b"\n")
+        self._records += 1
+        if self._records >= self.FLUSH_RECORDS:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.flush_interval, self.flush)
+        if record[4]:
+            with self._index:
+                self._index.execute("INSERT INTO pms VALUES (?, ?, ?, ?, ?, ?)",
+                                    (record[4], chat, record[2], message.id, date, self._segment))
+
+    def search(self, query, limit=20):
+        # Control characters mark the hits, so the text can be escaped before they become tags
+        rows = self._index.execute("SELECT sender, date, snippet(pms, 0, '\x02', '\x03', '...', 16) FROM pms "
+                                   "WHERE pms MATCH ? ORDER BY rank LIMIT ?", (query, limit)).fetchall()
+        return [(sender, date, utils.escape_html(snippet).replace("\x02", "<b>").replace("\x03", "</b>"))
+                for sender, date, snippet in rows]
+
+    def flush(self):
+        """Finishes the current gzip member, the next record starts a new one"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._records = 0
+
+    def _open(self):
+        if os.path.exists(self._name()) and os.path.getsize(self._name()) >= self.segment_size:
+            self._segment += 1
+        self._file = gzip.open(self._name(), "ab")
+
+    def _name(self):
+        return os.path.join(self.path, "segment-{:06d}.jsonl.gz".format(self._segment))
@@ -15,7 +15,9 @@
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from .. import loader, utils
+import asyncio
 import logging
+import time
 import telethon
 
 logger = logging.getLogger(__name__)
@@ -27,19 +29,31 @@ class PurgeMod(loader.Module):
     strings = {"name": "Purge",
                "from_where": "<b>Which messages should be purged?</b>",
                "not_supergroup_bot": "<b>Purges can only take place in supergroups</b>",
-               "delete_what": "<b>What message should be deleted?</b>"}
+               "delete_what": "<b>What message should be deleted?</b>",
+               "purge_count": "<b>{} messages would be purged</b>",
+               "purging": "<b>Purging... {} messages deleted</b>",
+               "purged": "<b>Purged {} messages</b>",
+               "workers_cfg_doc": "How many delete requests a purge can have in flight at once"}
+
+    def __init__(self):
+        self.config = loader.ModuleConfig("DELETE_WORKERS", 3, lambda m: self.strings("workers_cfg_doc", m))
 
     @loader.group_admin_delete_messages
     @loader.ratelimit
     async def purgecmd(self, message):
-        """Purge from the replied message"""
+        """.purge [count] [users...]
+           Purge from the replied message, only the messages of users if given.
+           With count, only report how many messages would be purged"""
         if not message.is_reply:
             await utils.answer(message, self.strings("from_where", message))
             return
 
         from_users = set()
         args = utils.get_args(message)
+        dry_run = "count" in args
         for arg in args:
+            if arg == "count":
+                continue
             try:
                 entity = await message.client.get_entity(arg)
                 if isinstance(entity, telethon.tl.types.User):
@@ -47,35 +61,110 @@ class PurgeMod(loader.Module):
             except ValueError:
                 pass
 
-        msgs = []
         from_ids = set()
         if await message.client.is_bot():
             if not message.is_channel:
                 await utils.answer(message, self.strings("not_supergroup_bot", message))
                 return
-            for msg in range(message.reply_to_msg_id, message.id + 1):
-                msgs.append(msg)
-                if len(msgs) >= 99:
-                    logger.debug(msgs)
-                    await message.client.delete_messages(message.to_id, msgs)
-                    msgs.clear()
+            batches = self._range_batches(message.reply_to_msg_id, message.id + 1)
         else:
+            batches = self._history_batches(message, from_users, from_ids)
+        if dry_run:
+            count = sum([len(msgs) async for msgs in batches])
+            await utils.answer(message, self.strings("purge_count", message).format(count))
+            return
+        # Bots can't edit the command, and the command itself is purged with the last batch
+        progress = None if await message.client.is_bot() else self._progress(message)
+        deleted = await self._delete_batches(message.client, message.to_id, batches, progress)
+        await self.allmodules.log("purge", group=message.to_id, affected_uids=from_ids)
+        done = await message.client.send_message(message.to_id, self.strings("purged", message).format(deleted))
+        await asyncio.sleep(3)
+        await done.delete()
+
+    def _progress(self, message, interval=5):
+        last = [time.monotonic()]
+
+        def progress(deleted):
+            if time.monotonic() - last[0] >= interval:
+                last[0] = time.monotonic()
+                asyncio.ensure_future(self._edit_progress(message, deleted))
+        return progress
+
+    async def _edit_progress(self, message, deleted):
+        try:
+            await message.edit(self.strings("purging", message).format(deleted))
+        except telethon.errors.MessageIdInvalidError:
+            pass  # Already purged
+        except telethon.errors.RPCError:
+            logger.debug("Could not report purge progress", exc_info=True)
+
+    async def _range_batches(self, start, end):
+        for first in range(start, end, 100):
+            yield list(range(first, min(first + 100, end)))
+
+    async def _history_batches(self, message, from_users, from_ids):
+        # The sender filter runs server side, one search per user, so other messages are never downloaded
+        msgs = []
+        for from_user in from_users or [None]:
             async for msg in message.client.iter_messages(
                     entity=message.to_id,
                     min_id=message.reply_to_msg_id - 1,
+                    from_user=from_user,
                     reverse=True):
-                if from_users and msg.from_id not in from_users:
-                    continue
                 msgs.append(msg.id)
                 from_ids.add(msg.from_id)
-                if len(msgs) >= 99:
-                    logger.debug(msgs)
-                    await message.client.delete_messages(message.to_id, msgs)
-                    msgs.clear()
+                if len(msgs) >= 100:
+                    yield msgs
+                    msgs = []
         if msgs:
-            logger.debug(msgs)
-            await message.client.delete_messages(message.to_id, msgs)
-        await self.allmodules.log("purge", group=message.to_id, affected_uids=from_ids)
+            yield msgs
+
+    async def _delete_batches(self, client, peer, batches, progress=None):
+        """Deletes the id batches while the next ones are still being fetched, with a pool of workers.
+           A flood wait pauses every worker, not only the one that hit it.
+           progress is called with the running total after every batch"""
+        queue = asyncio.Queue(max(self.config["DELETE_WORKERS"], 1) * 2)
+        loop = asyncio.get_event_loop()
+        state = {"resume": 0, "deleted": 0, "error": None}
+
+        async def worker():
+            while True:
+                msgs = await queue.get()
+                if msgs is None:
+                    return
+                while state["error"] is None:
+                    delay = state["resume"] - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    try:
+                        logger.debug(msgs)
+                        await client.delete_messages(peer, msgs)
+                    except telethon.errors.FloodWaitError as e:
+                        logger.debug("Flood wait of %d seconds while purging", e.seconds)
+                        state["resume"] = max(state["resume"], loop.time() + e.seconds)
+                    except Exception as e:
+                        # Keep draining the queue so the producer never blocks, and re-raise later
+                        state["error"] = e
+                    else:
+                        state["deleted"] += len(msgs)
+                        logger.debug("Purged %d messages so far", state["deleted"])
+                        if progress is not None:
+                            progress(state["deleted"])
+                        break
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(max(self.config["DELETE_WORKERS"], 1))]
+        try:
+            async for msgs in batches:
+                if state["error"] is not None:
+                    break
+                await queue.put(msgs)
+        finally:
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        if state["error"] is not None:
+            raise state["error"]
+        return state["deleted"]
 
     @loader.group_admin_delete_messages
     @loader.ratelimit
@@ -0,0 +1,100 @@
+#    Friendly Telegram (telegram userbot)
+#    Copyright (C) 2018-2019 The Authors
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Replays a mixed message stream through DoNotDisturbMod.watcher and reports the cost per message.
+
+DND is loaded into an installed Friendly-Telegram, the way .dlmod would, with a client that only counts
+what would have been sent. Most of the stream is ordinary group chatter, with a share of mentions and PMs.
+Run it from the directory containing friendly-telegram:
+
+    python /path/to/tools/dnd_replay.py --messages 50000 --pms 0.02 --mentions 0.03 --afk"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ftg_harness  # noqa: E402
+
+
+def make_stream(client, args):
+    stream = []
+    for i in range(args.messages):
+        sender = ftg_harness.ME + 1 + random.randrange(args.senders)
+        roll = random.random()
+        if roll < args.pms:
+            kind, message = "pm", ftg_harness.make_message(client, sender, i + 1, "hi")
+        elif roll < args.pms + args.mentions:
+            kind = "mention"
+            message = ftg_harness.make_message(client, sender, i + 1, "@me look", chat=1 + i % args.chats,
+                                               mentioned=True)
+        else:
+            kind, message = "group", ftg_harness.make_message(client, sender, i + 1, "chatter", chat=1 + i % args.chats)
+        stream.append((kind, message))
+    return stream
+
+
+async def run(args):
+    dnd = ftg_harness.load_module(args.package, ftg_harness.module_path("dnd"))
+    client = ftg_harness.Client()
+    mod = ftg_harness.instantiate(dnd, "DoNotDisturbMod")
+    db = ftg_harness.Database()
+    await mod.client_ready(client, db)
+    if args.afk:
+        db.set(dnd.__name__, "afk", True)
+        db.set(dnd.__name__, "afk_gone", time.time())
+    db.set(dnd.__name__, "pm", args.allow_pms)
+    # Built up front, so only the watcher is timed
+    stream = make_stream(client, args)
+    costs = {}
+    started = time.perf_counter()
+    for kind, message in stream:
+        start = time.perf_counter()
+        await mod.watcher(message)
+        costs.setdefault(kind, []).append(time.perf_counter() - start)
+    elapsed = time.perf_counter() - started
+    if mod._flush is not None:
+        mod._flush.cancel()
+    print("{} messages in {:.2f} s ({:.2f} us/message), {} replies, {} other requests".format(
+        args.messages, elapsed, elapsed / args.messages * 1e6, client.sent, sum(client.requests.values())))
+    for kind in ("group", "mention", "pm"):
+        values = costs.get(kind, [])
+        print("{:<8} {:>7} messages  mean {:8.2f} us  p50 {:8.2f} us  p99 {:8.2f} us".format(
+            kind, len(values), sum(values) / max(len(values), 1) * 1e6,
+            *(1e6 * ftg_harness.percentile(values, p) for p in (50, 99))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--package", default="friendly-telegram", help="FTG package to load DND into")
+    parser.add_argument("--messages", type=int, default=50000, help="messages to replay")
+    parser.add_argument("--pms", type=float, default=0.02, help="share of PMs")
+    parser.add_argument("--mentions", type=float, default=0.03, help="share of group messages mentioning us")
+    parser.add_argument("--senders", type=int, default=2000, help="distinct senders")
+    parser.add_argument("--chats", type=int, default=50, help="distinct group chats")
+    parser.add_argument("--afk", action="store_true", help="replay while AFK")
+    parser.add_argument("--allow-pms", action="store_true", help="replay with the anti-PM answer disabled")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#    Friendly Telegram (telegram userbot)
+#    Copyright (C) 2018-2019 The Authors
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Measures the cost of matching one message against the filters of a chat, for a growing number of filters.
+
+The TriggerIndex of filters.py is loaded from an installed Friendly-Telegram, the way .dlmod would, and
+compared with the scan over every filter that watchout did before the index. Run it from the directory
+containing friendly-telegram:
+
+    python /path/to/tools/filters_bench.py --filters 10 100 1000 10000 --substring 0.1 --nocase 0.1"""
+
+import argparse
+import os
+import random
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ftg_harness  # noqa: E402
+
+
+def make_word(length):
+    return "".join(random.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def make_filters(count, args):
+    """Trigger name to mode, mostly single words, with a share of phrases, substrings and nocase triggers"""
+    filters = {}
+    while len(filters) < count:
+        roll = random.random()
+        if roll < args.substring:
+            filters[make_word(5)] = "substring"
+        elif roll < args.substring + args.nocase:
+            filters[make_word(6).capitalize()] = "nocase"
+        elif roll < args.substring + args.nocase + args.phrases:
+            filters[make_word(5) + " " + make_word(5)] = "word"
+        else:
+            filters[make_word(random.randint(3, 8))] = "word"
+    return filters
+
+
+def make_messages(filters, args):
+    """Messages of --words words, one in --hit-rate of them contains a trigger"""
+    triggers = list(filters)
+    messages = []
+    for _ in range(args.messages):
+        words = [make_word(random.randint(2, 8)) for _ in range(args.words)]
+        if random.random() < args.hit_rate:
+            words[random.randrange(len(words))] = random.choice(triggers)
+        messages.append(" ".join(words))
+    return messages
+
+
+def scan(filters, chatid, text):
+    # What watchout did before the index, without fetching the assets
+    if chatid not in str(filters):
+        return []
+    args = text.split(" ")
+    return [key for key in filters[chatid] if key in args]
+
+
+def measure(func, messages, repeat):
+    best = min(timeit.repeat(lambda: [func(text) for text in messages], number=1, repeat=repeat))
+    return best / len(messages) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--package", default="friendly-telegram", help="FTG package to load Filters into")
+    parser.add_argument("--filters", type=int, nargs="+", default=[10, 100, 1000, 10000],
+                        help="numbers of filters in the chat to measure")
+    parser.add_argument("--substring", type=float, default=0.1, help="share of substring triggers")
+    parser.add_argument("--nocase", type=float, default=0.1, help="share of nocase triggers")
+    parser.add_argument("--phrases", type=float, default=0.1, help="share of multi-word triggers")
+    parser.add_argument("--messages", type=int, default=1000, help="distinct messages to match")
+    parser.add_argument("--words", type=int, default=12, help="words per message")
+    parser.add_argument("--hit-rate", type=float, default=0.1, help="share of messages containing a trigger")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per measurement, the fastest is reported")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    filters_module = ftg_harness.load_module(args.package, ftg_harness.module_path("filters"))
+    print("{:>8}  {:>12}  {:>12}  {:>8}".format("filters", "index us/msg", "scan us/msg", "speedup"))
+    for count in args.filters:
+        modes = make_filters(count, args)
+        messages = make_messages(modes, args)
+        index = filters_module.TriggerIndex(modes, modes)
+        # Word triggers only, the scan had no other modes
+        filters = {"1": {key: 0 for key, mode in modes.items() if mode == "word"}}
+        # The automaton and the patterns are built on the first match, not per message
+        index.match(messages[0])
+        indexed = measure(index.match, messages, args.repeat)
+        scanned = measure(lambda text: scan(filters, "1", text), messages, args.repeat)
+        print("{:>8}  {:>12.2f}  {:>12.2f}  {:>7.1f}x".format(count, indexed, scanned, scanned / indexed))
+
+
+if __name__ == "__main__":
+    main()
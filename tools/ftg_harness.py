@@ -0,0 +1,135 @@
+#    Friendly Telegram (telegram userbot)
+#    Copyright (C) 2018-2019 The Authors
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Shared pieces of the scripts in tools: loading a module into an installed Friendly-Telegram,
+and the database, client and messages it sees in place of a logged in userbot."""
+
+import collections
+import datetime
+import importlib
+import importlib.util
+import os
+import sys
+
+from telethon.tl import types
+
+ME = 1000
+
+
+class Database(dict):
+    """Just enough of the FTG database for the modules"""
+
+    def get(self, owner, key, default=None):
+        return super().get(owner, {}).get(key, default)
+
+    def set(self, owner, key, value):
+        self.setdefault(owner, {})[key] = value
+
+    def save(self):
+        pass
+
+
+class Client:
+    """Stands in for the Telegram client, counts what the module sends instead of sending it"""
+    _self_id = ME
+
+    def __init__(self):
+        self.sent = 0
+        self.requests = collections.Counter()
+
+    async def __call__(self, request):
+        self.requests[type(request).__name__] += 1
+        return True
+
+    async def get_me(self, input_peer=False):
+        return types.InputPeerUser(ME, 0) if input_peer else types.User(id=ME, is_self=True, access_hash=0)
+
+    async def send_read_acknowledge(self, *args, **kwargs):
+        self.requests["ReadHistoryRequest"] += 1
+        return True
+
+    async def send_message(self, entity, *args, **kwargs):
+        self.sent += 1
+
+    async def edit_message(self, entity, *args, **kwargs):
+        self.sent += 1
+
+
+def load_module(package, path):
+    """Loads the module file into package, the way .dlmod does"""
+    # FTG is run as "python -m friendly-telegram", so its package is found from the working directory
+    sys.path.insert(0, os.getcwd())
+    importlib.import_module(package)
+    name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(package + ".modules." + name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class Strings:
+    """What the FTG loader turns a module's strings dict into, without the translations"""
+
+    def __init__(self, strings):
+        self._strings = strings
+
+    def __call__(self, key, message=None):
+        return self._strings[key]
+
+    def __getitem__(self, key):
+        return self._strings[key]
+
+
+def instantiate(module, cls_name):
+    """Creates the module class and sets up its strings, as the loader does on registration"""
+    mod = getattr(module, cls_name)()
+    if isinstance(mod.strings, dict):
+        mod.strings = Strings(mod.strings)
+    return mod
+
+
+def module_path(name):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", name + ".py")
+
+
+def make_message(client, sender, msg_id, text, chat=None, mentioned=False, bot=False):
+    """Builds an incoming message as current Telethon delivers it: a PM when chat is None,
+       otherwise a supergroup message, with the sender entity already attached"""
+    if chat is None:
+        peer, from_id = types.PeerUser(sender), None
+        input_chat = types.InputPeerUser(sender, 0)
+    else:
+        peer, from_id = types.PeerChannel(chat), types.PeerUser(sender)
+        input_chat = types.InputPeerChannel(chat, 0)
+    message = types.Message(id=msg_id, peer_id=peer, date=datetime.datetime.now(datetime.timezone.utc),
+                            message=text, from_id=from_id, mentioned=mentioned)
+    user = types.User(id=sender, first_name="user{}".format(sender), access_hash=0, bot=bot)
+    # What Message._finish_init would fill in from the update, without needing a real client
+    message._client = client
+    message._sender = user
+    message._input_sender = types.InputPeerUser(sender, 0)
+    message._chat = user if chat is None else types.Channel(id=chat, title="chat{}".format(chat), photo=None,
+                                                              date=None, megagroup=True, access_hash=0)
+    message._input_chat = input_chat
+    return message
+
+
+def percentile(values, percent):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
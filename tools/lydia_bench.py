@@ -0,0 +1,132 @@
+#    Friendly Telegram (telegram userbot)
+#    Copyright (C) 2018-2019 The Authors
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Drives synthetic PM streams through LydiaMod.watcher and reports reply latency and event loop lag.
+
+Lydia is loaded into an installed Friendly-Telegram, the way .dlmod would, and talks to the stand-in
+from lydia_standin.py (started in process unless --url is given). Telegram itself is replaced by a
+client that only records what Lydia sends. Run it from the directory containing friendly-telegram:
+
+    python /path/to/tools/lydia_bench.py --users 50 --messages 10 --concurrency 4
+
+Reply latency is measured from the oldest unanswered message of a user to the reply, so it includes
+the coalescing window, the queue and the completion request."""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ftg_harness  # noqa: E402
+import lydia_standin  # noqa: E402
+
+
+class Client(ftg_harness.Client):
+    """Also records when each user got a reply"""
+
+    def __init__(self, pending, latencies):
+        super().__init__()
+        self._pending = pending
+        self.latencies = latencies
+
+    async def send_message(self, entity, *args, **kwargs):
+        await super().send_message(entity, *args, **kwargs)
+        user = entity.user_id
+        if self._pending.get(user):
+            self.latencies.append(time.monotonic() - self._pending[user][0])
+            self._pending[user].clear()
+
+
+async def measure_lag(lags, interval=0.01):
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        lags.append(time.monotonic() - start - interval)
+
+
+async def stream(mod, client, pending, user, count, gap, ids):
+    for _ in range(count):
+        await asyncio.sleep(random.expovariate(1 / gap) if gap else 0)
+        pending.setdefault(user, []).append(time.monotonic())
+        text = random.choice(["hi", "hey", "you there?", "what's up", "answer me"])
+        await mod.watcher(ftg_harness.make_message(client, user, next(ids), text))
+
+
+async def run(args):
+    lydia = ftg_harness.load_module(args.package, args.module)
+    runner = None
+    url = args.url
+    if url is None:
+        runner, url = await lydia_standin.start(lydia_standin.StandIn(args.latency, args.jitter))
+    pending, latencies, lags = {}, [], []
+    client = Client(pending, latencies)
+    mod = ftg_harness.instantiate(lydia, "LydiaMod")
+    mod.config.update({"CLIENT_KEY": "standin", "API_URL": url, "NOTIFY": True,
+                       "CONCURRENCY": args.concurrency, "QUEUE_SIZE": args.queue_size,
+                       "COALESCE_WINDOW": args.coalesce_window})
+    db = ftg_harness.Database({lydia.__name__: {"__config__": {"NOTIFY": True}}})
+    await mod.client_ready(client, db)
+    lag_task = asyncio.ensure_future(measure_lag(lags))
+    ids = iter(range(1, 1 << 62))
+    started = time.monotonic()
+    await asyncio.gather(*(stream(mod, client, pending, ftg_harness.ME + user, args.messages, args.gap, ids)
+                           for user in range(1, args.users + 1)))
+    # Let the last bursts and replies drain
+    deadline = time.monotonic() + args.drain
+    while any(pending.values()) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.monotonic() - started
+    lag_task.cancel()
+    for worker in mod._workers:
+        worker.cancel()
+    if mod._flush is not None:
+        mod._flush.cancel()
+    await mod._get_session().close()
+    if runner is not None:
+        await runner.cleanup()
+
+    print("{} users x {} messages, {} replies sent in {:.2f} s, {} users left waiting".format(
+        args.users, args.messages, client.sent, elapsed, sum(1 for times in pending.values() if times)))
+    for name, values in (("reply latency", latencies), ("event loop lag", lags)):
+        print("{:<15} p50 {:8.1f} ms  p95 {:8.1f} ms  p99 {:8.1f} ms  max {:8.1f} ms".format(
+            name, *(1000 * ftg_harness.percentile(values, p) for p in (50, 95, 99, 100))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--package", default="friendly-telegram", help="FTG package to load Lydia into")
+    parser.add_argument("--module", default=ftg_harness.module_path("lydia"))
+    parser.add_argument("--url", help="completions endpoint to use instead of an in process stand-in")
+    parser.add_argument("--latency", type=float, default=0.5, help="stand-in latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.2, help="stand-in latency jitter in seconds")
+    parser.add_argument("--users", type=int, default=50, help="concurrent PM streams")
+    parser.add_argument("--messages", type=int, default=10, help="messages per stream")
+    parser.add_argument("--gap", type=float, default=1.0, help="mean seconds between messages of a stream")
+    parser.add_argument("--concurrency", type=int, default=4, help="Lydia CONCURRENCY")
+    parser.add_argument("--queue-size", type=int, default=32, help="Lydia QUEUE_SIZE")
+    parser.add_argument("--coalesce-window", type=float, default=3, help="Lydia COALESCE_WINDOW")
+    parser.add_argument("--drain", type=float, default=60, help="seconds to wait for the last replies")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
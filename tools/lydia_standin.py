@@ -0,0 +1,97 @@
+#    Friendly Telegram (telegram userbot)
+#    Copyright (C) 2018-2019 The Authors
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Local stand-in for the chat completions endpoint Lydia talks to.
+
+Answers every POST with a canned reply after a configurable delay, in the OpenAI response format,
+so Lydia can be tested and measured offline. Point Lydia's API_URL config value at it:
+
+    python tools/lydia_standin.py --latency 0.5 --jitter 0.2
+    .setconfig Lydia API_URL http://127.0.0.1:8080/v1/chat/completions
+
+This is not an FTG module and is not listed in any module manifest."""
+
+import argparse
+import asyncio
+import itertools
+import random
+import time
+
+from aiohttp import web
+
+REPLIES = ["lol", "yeah sure", "hmm not sure about that", "ok", "who is this?", "sounds good, talk later"]
+
+
+class StandIn:
+    """Serves canned completions. latency and jitter are in seconds, error_rate is the share of 500 answers"""
+
+    def __init__(self, latency=0.5, jitter=0.0, replies=None, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self._replies = itertools.cycle(replies or REPLIES)
+
+    async def handle(self, request):
+        self.requests += 1
+        body = await request.json()
+        await asyncio.sleep(max(self.latency + random.uniform(-self.jitter, self.jitter), 0))
+        if self.error_rate and random.random() < self.error_rate:
+            return web.json_response({"error": {"message": "stand-in error"}}, status=500)
+        return web.json_response({
+            "id": "standin-{}".format(self.requests),
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "standin"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": next(self._replies)}}],
+        })
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/{tail:.*}", self.handle)
+        return app
+
+
+async def start(standin, host="127.0.0.1", port=0):
+    """Runs the stand-in in the current event loop, returns the runner and the completions URL"""
+    runner = web.AppRunner(standin.app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, "http://{}:{}/v1/chat/completions".format(host, port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds before every answer")
+    parser.add_argument("--jitter", type=float, default=0.0, help="latency varies uniformly by up to this much")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with a 500")
+    parser.add_argument("--replies", help="file with one canned reply per line, used in turn")
+    args = parser.parse_args()
+    replies = None
+    if args.replies:
+        with open(args.replies, encoding="utf-8") as file:
+            replies = [line.strip() for line in file if line.strip()]
+    standin = StandIn(args.latency, args.jitter, replies, args.error_rate)
+    web.run_app(standin.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#    Friendly Telegram (telegram userbot)
+#    Copyright (C) 2018-2019 The Authors
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Drives a flood of synthetic PMs through AntiPMMod.watcher and reports the cost per PM and the memory kept.
+
+Anti PM is loaded into an installed Friendly-Telegram, the way .dlmod would, with a client that only counts
+what would have been sent. Run it from the directory containing friendly-telegram:
+
+    python /path/to/tools/nopm_loadtest.py --pms 100000 --senders 100000
+
+The cost per PM is reported for every tenth of the run, so growth with the number of senders shows up."""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ftg_harness  # noqa: E402
+
+
+async def run(args):
+    nopm = ftg_harness.load_module(args.package, ftg_harness.module_path("nopm"))
+    client = ftg_harness.Client()
+    mod = ftg_harness.instantiate(nopm, "AntiPMMod")
+    mod.config.update({"PM_BLOCK_LIMIT": args.block_limit, "RATELIMIT_WINDOW": args.window})
+    await mod.client_ready(client, ftg_harness.Database())
+    if args.trace_memory:
+        tracemalloc.start()
+    step = max(args.pms // 10, 1)
+    started = lap = time.perf_counter()
+    for i in range(args.pms):
+        sender = ftg_harness.ME + 1 + (i if args.senders >= args.pms else random.randrange(args.senders))
+        await mod.watcher(ftg_harness.make_message(client, sender, i + 1, "hello"))
+        if (i + 1) % step == 0:
+            now = time.perf_counter()
+            print("{:>8} PMs  {:8.1f} us/PM  {:>6} ids in the rate limiter".format(
+                i + 1, (now - lap) / step * 1e6, len(mod._ratelimit)))
+            lap = now
+    elapsed = time.perf_counter() - started
+    if mod._flush is not None:
+        mod._flush.cancel()
+    print("{} PMs from {} senders in {:.2f} s ({:.1f} us/PM), {} answers, {} blocks".format(
+        args.pms, min(args.senders, args.pms), elapsed, elapsed / args.pms * 1e6, client.sent,
+        client.requests["BlockRequest"]))
+    if args.trace_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        print("memory still allocated {:.1f} MiB, peak {:.1f} MiB".format(current / 2 ** 20, peak / 2 ** 20))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--package", default="friendly-telegram", help="FTG package to load Anti PM into")
+    parser.add_argument("--pms", type=int, default=100000, help="PMs to deliver")
+    parser.add_argument("--senders", type=int, default=100000, help="distinct senders, picked at random if fewer")
+    parser.add_argument("--window", type=float, default=5, help="Anti PM RATELIMIT_WINDOW")
+    parser.add_argument("--block-limit", type=int, default=None, help="Anti PM PM_BLOCK_LIMIT")
+    parser.add_argument("--trace-memory", action="store_true", help="measure allocations with tracemalloc (slower)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()